@@ -0,0 +1,152 @@
+"""
+Benchmark of chart rendering.
+
+Renders charts from random hourly series in a fresh process for each mode:
+- previous: the renderer as it was before templates (a copy kept below,
+  24-hour charts only), with margins computed by bbox_inches='tight';
+- fresh: a new template (fixed margins) is built for every chart;
+- template: one figure template per process, only the series are swapped in;
+- light: template at --light-dpi dots per inch (see CHART_DPI).
+
+Usage:
+    python -m bench.charts --charts 200 --output charts.json
+
+Reports charts per second, average PNG size and peak RSS of each mode as JSON.
+"""
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from bench.run import git_revision
+
+MODES = ("previous", "fresh", "template", "light")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--charts", type=int, default=200, help="number of charts to render in each mode")
+    parser.add_argument("--hours", type=int, default=24, help="hours in each chart")
+    parser.add_argument("--light-dpi", type=int, default=60, help="resolution of the 'light' mode")
+    parser.add_argument("--output", help="file to write JSON results to (stdout by default)")
+    return parser.parse_args()
+
+def random_hourly(rnd: random.Random, hours: int) -> dict:
+    base = rnd.uniform(-20, 30)
+    rainy = rnd.random() < 0.5
+    return {
+        "temp": [round(base + rnd.uniform(-5, 5), 1) for _ in range(hours)],
+        "apparent_temp": [round(base + rnd.uniform(-8, 3), 1) for _ in range(hours)],
+        "wind": [round(rnd.uniform(0, 30), 1) for _ in range(hours)],
+        "precipitation_prob": [rnd.randint(0, 100) if rainy else 0 for _ in range(hours)]
+    }
+
+def render_previous(hourly: dict) -> bytes:
+    """
+    Copy of charts.render_chart before figure templates, kept as the baseline
+    """
+    import io
+    from matplotlib.figure import Figure
+    from charts import _style_axis, BACKGROUND, FOREGROUND, FONT_SIZE
+    hours = [i for i in range(0, 24)]
+    fig = Figure(figsize=(16,9), facecolor=BACKGROUND)
+    ax1 = fig.subplots()
+    _style_axis(ax1)
+    graph1, = ax1.plot(hours, hourly["temp"], 's-',
+             markersize=5, color='cyan', label = 'temperature', zorder=2)
+    graph2, = ax1.plot(hours, hourly["apparent_temp"], 'D-',
+             markersize=5, color='blueviolet', label = 'apparent temperature')
+    ax2 = ax1.twinx()
+    _style_axis(ax2)
+    graph3, = ax2.plot(hours, hourly["wind"], 'o-',
+             markersize=5, color='lime', label = 'wind')
+    ax1.grid(color=FOREGROUND)
+    ax1.set_xticks(hours)
+    ax1.set_xlabel('Hours', color=FOREGROUND, fontsize=FONT_SIZE)
+    ax1.set_xlim(-0.5,23.5)
+    ax1.set_ylabel("°C", color=FOREGROUND, fontsize=FONT_SIZE)
+    ax2.set_ylabel("km/h", color=FOREGROUND, fontsize=FONT_SIZE)
+    ax2.spines['left'].set_position(('outward', 50))
+    ax2.yaxis.set_label_position('left')
+    ax2.yaxis.set_ticks_position('left')
+    if max(hourly["precipitation_prob"]) >= 5:
+        ax3 = ax1.twinx()
+        _style_axis(ax3)
+        graph4 = ax3.bar(hours, hourly["precipitation_prob"],
+                          color='coral', alpha=0.5,label="precipitation prob.")
+        ax3.set_ylabel("%", color=FOREGROUND, fontsize=FONT_SIZE)
+        ax3.spines['left'].set_position(('outward', 100))
+        ax3.yaxis.set_label_position('left')
+        ax3.yaxis.set_ticks_position('left')
+        graphs = [graph1, graph2, graph3, graph4]
+    else:
+        graphs = [graph1, graph2, graph3]
+    labels = [graph.get_label() for graph in graphs]
+    legend = ax1.legend(graphs, labels, loc="lower left", fontsize=FONT_SIZE,
+                        facecolor=BACKGROUND, edgecolor=FOREGROUND)
+    for text in legend.get_texts():
+        text.set_color(FOREGROUND)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight", facecolor=BACKGROUND)
+    return buffer.getvalue()
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def run_mode(mode: str, charts: int, hours: int, light_dpi: int) -> dict:
+    # Runs in its own process, so that peak RSS of the modes is not mixed up
+    import charts as chart_module
+    rnd = random.Random(0)
+    series = [random_hourly(rnd, hours) for _ in range(charts)]
+    rss_before = peak_rss_mb()
+    size = 0
+    start = time.perf_counter()
+    for hourly in series:
+        if mode == "previous":
+            png = render_previous(hourly)
+        elif mode == "fresh":
+            png = chart_module.render_chart(hourly, reuse=False)
+        elif mode == "template":
+            png = chart_module.render_chart(hourly)
+        else:
+            png = chart_module.render_chart(hourly, dpi=light_dpi)
+        size += len(png)
+    elapsed = time.perf_counter() - start
+    return {
+        "charts": charts,
+        "seconds": round(elapsed, 3),
+        "per_sec": round(charts / elapsed, 2),
+        "png_kb": round(size / charts / 1024, 1),
+        "peak_rss_mb_before_rendering": rss_before,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+def main():
+    args = parse_args()
+    started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    result = {}
+    for mode in MODES:
+        if mode == "previous" and args.hours != 24:
+            continue
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result[mode] = pool.submit(run_mode, mode, args.charts, args.hours, args.light_dpi).result()
+    report = {
+        "started": started,
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "results": result
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Offline benchmark of the bot.
+
+Runs the real handlers from main.py and utils.make_forecast against local stand-ins
+of Open-Meteo, Geoapify, OpenWeatherMap and Telegram Bot API (see stubs.py)
+and a local PostgreSQL database configured by DB_* variables, as for the bot itself
+(e.g. `docker compose up db` with DB_HOST=localhost).
+
+Usage:
+    python -m bench.run --subscribers 1000 --forecasts 500 --output result.json
+
+Prints (or writes to --output) results as JSON, so they can be compared across versions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from bench.stubs import (StubConfig, start_stub, open_meteo_app, geoapify_app,
+                         openweathermap_app, telegram_app)
+
+# Chat ids of the benchmark's users, far from real Telegram ids
+BASE_CHAT_ID = 9 * 10**15
+CITIES = [(51.51, -0.13, "Europe/London"), (48.86, 2.35, "Europe/Paris"),
+          (40.71, -74.01, "America/New_York"), (35.68, 139.69, "Asia/Tokyo"),
+          (28.61, 77.21, "Asia/Kolkata"), (-33.87, 151.21, "Australia/Sydney"),
+          (55.76, 37.62, "Europe/Moscow"), (-23.55, -46.63, "America/Sao_Paulo")]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=300,
+                        help="number of users receiving daily forecasts in the same minute")
+    parser.add_argument("--forecasts", type=int, default=200, help="number of /forecast commands")
+    parser.add_argument("--concurrency", type=int, default=20, help="simultaneous /forecast commands")
+    parser.add_argument("--locations", type=int, default=50,
+                        help="number of distinct locations (grid cells) users live in")
+    parser.add_argument("--latency", type=float, default=50, help="stand-ins' latency, ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="stand-ins' error rate, 0..1")
+    parser.add_argument("--send-rate", type=float, default=30, help="Telegram messages per second")
+    parser.add_argument("--output", help="file to write JSON results to (stdout by default)")
+    return parser.parse_args()
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+class LoopMonitor:
+    """
+    Measures how long the event loop was unable to run a task scheduled every 'interval' seconds
+    """
+    def __init__(self, interval: float = 0.01, threshold: float = 0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.stall_total = 0.0
+        self.stall_max = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            if lag > self.threshold:
+                self.stall_total += lag
+                self.stall_max = max(self.stall_max, lag)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> dict:
+        self._task.cancel()
+        return {"stall_ms_total": round(self.stall_total * 1000, 1),
+                "stall_ms_max": round(self.stall_max * 1000, 1)}
+
+def make_update(update_id: int, chat_id: int, text: str):
+    from aiogram.types import Update, Message, Chat, User
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=chat_id, type="private"),
+        from_user=User(id=chat_id, is_bot=False, first_name="bench"),
+        text=text
+    ))
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+async def run(args) -> dict:
+    config = StubConfig(latency=args.latency / 1000, error_rate=args.error_rate)
+    stubs = {}
+    for name, app in [("OPEN_METEO_URL", open_meteo_app(config)),
+                      ("GEOAPIFY_URL", geoapify_app(config)),
+                      ("OPENWEATHERMAP_URL", openweathermap_app(config)),
+                      ("TELEGRAM_API_URL", telegram_app(config))]:
+        stubs[name] = await start_stub(app)
+        os.environ[name] = stubs[name][1]
+    os.environ.setdefault("KEY_BOT", "123456:BENCHMARK")
+    os.environ["SEND_RATE"] = str(args.send_rate)
+
+    # configuration is read on import, so the bot is imported after stand-ins are up
+    import main
+    import utils
+    from init_db import init_db
+    from charts import open_chart_pool, close_chart_pool
+    from dispatcher import utc_minute
+    from timezones import offset_minutes
+
+    @utils.with_db
+    async def seed_users(conn, users):
+        await conn.execute("DELETE FROM weatherbot WHERE chat_id = ANY($1)", [u[0] for u in users])
+        await conn.executemany("""
+        INSERT INTO weatherbot (chat_id, lat, lon, tz_offset, tz, notify_local, notify_minute)
+        VALUES ($1, $2, $3, $4, $5, $6, $7);
+        """, users)
+
+    @utils.with_db
+    async def delete_users(conn, chat_ids):
+        await conn.execute("DELETE FROM weatherbot WHERE chat_id = ANY($1)", chat_ids)
+
+    rnd = random.Random(0)
+    locations = []
+    for i in range(args.locations):
+        lat, lon, tz = CITIES[i % len(CITIES)]
+        locations.append((lat + (i // len(CITIES)) * 0.5, lon, tz))
+    users = []
+    for i in range(max(args.subscribers, 1)):
+        lat, lon, tz = rnd.choice(locations)
+        # everyone is notified at 08:00 local time
+        users.append((BASE_CHAT_ID + i, lat + rnd.uniform(-0.01, 0.01), lon + rnd.uniform(-0.01, 0.01),
+                      int(offset_minutes(tz, 0) / 60), tz, 8 * 60, utc_minute(8, 0, offset_minutes(tz, 0))))
+    chat_ids = [u[0] for u in users]
+
+    await utils.open_db_pool()
+    await init_db()
+    await seed_users(users)
+    await utils.open_http_session()
+    open_chart_pool()
+    main.send_queue.start()
+    monitor = LoopMonitor()
+    monitor.start()
+    result = {}
+    try:
+        # /forecast commands from random users, starting with cold caches
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def forecast(i):
+            async with semaphore:
+                update = make_update(i + 1, rnd.choice(chat_ids), "/forecast")
+                start = time.perf_counter()
+                await main.dp.feed_update(main.bot, update)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[forecast(i) for i in range(args.forecasts)])
+        elapsed = time.perf_counter() - start
+        result["forecasts"] = {
+            "count": args.forecasts,
+            "seconds": round(elapsed, 3),
+            "per_sec": round(args.forecasts / elapsed, 2) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1)
+        }
+
+        # notification burst: all subscribers due in the same minute
+        utils.forecast_cache.clear()
+        for user in users:
+            main.dispatcher.add(user[0], user[6])
+        minutes = {user[6] for user in users}
+        sent_before = main.send_queue.sent
+        start = time.perf_counter()
+        await asyncio.gather(*[main.dispatcher.dispatch(minute) for minute in minutes])
+        elapsed = time.perf_counter() - start
+        result["notifications"] = {
+            "subscribers": len(users),
+            "sent": main.send_queue.sent - sent_before,
+            "seconds": round(elapsed, 3)
+        }
+    finally:
+        result["event_loop"] = monitor.stop()
+        result["send_queue"] = main.send_queue.stats()
+        result["upstream_requests"] = dict(config.requests)
+        result["caches"] = {
+            "forecast": {"hits": utils.forecast_cache.hits, "misses": utils.forecast_cache.misses},
+            "charts": {"hits": utils.chart_store.hits, "misses": utils.chart_store.misses},
+            "users": {"hits": utils.user_cache.hits, "misses": utils.user_cache.misses}
+        }
+        for chat_id in chat_ids:
+            main.dispatcher.remove(chat_id)
+        await main.send_queue.stop()
+        close_chart_pool()
+        await utils.close_http_session()
+        await delete_users(chat_ids)
+        await utils.close_db_pool()
+        await main.bot.session.close()
+        for runner, url in stubs.values():
+            await runner.cleanup()
+    return result
+
+def main():
+    args = parse_args()
+    started = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    result = asyncio.run(run(args))
+    report = {
+        "started": started,
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "results": result
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
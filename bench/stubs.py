@@ -0,0 +1,139 @@
+"""
+Local stand-ins for the upstream APIs used by the bot:
+Open-Meteo, Geoapify, OpenWeatherMap and Telegram Bot API.
+Each one answers after a configurable latency and fails with a configurable rate.
+"""
+from aiohttp import web
+from datetime import datetime, timedelta, timezone
+import asyncio
+import random
+import time
+
+class StubConfig:
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {}
+
+    async def delay(self, name: str) -> bool:
+        """
+        Waits for the configured latency and counts the request.
+        Returns True if the request should fail.
+        """
+        self.requests[name] = self.requests.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        return random.random() < self.error_rate
+
+def _forecast(lat: float, lon: float, days: int = 1) -> dict:
+    rnd = random.Random(f"{lat},{lon}")
+    now = datetime.now(timezone.utc)
+    dates = [(now + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+    hours = 24 * days
+    base = rnd.uniform(-10, 30)
+    temps = [round(base + 5 * rnd.random(), 1) for _ in range(hours)]
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "current": {
+            "time": now.replace(minute=now.minute // 15 * 15, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M"),
+            "temperature_2m": temps[now.hour],
+            "relative_humidity_2m": rnd.randint(20, 100),
+            "is_day": int(6 <= now.hour < 20),
+            "rain": 0.0,
+            "wind_speed_10m": round(rnd.uniform(0, 30), 1),
+            "cloud_cover": rnd.randint(0, 100),
+            "apparent_temperature": temps[now.hour] - 2
+        },
+        "hourly": {
+            "time": [f"{day}T{h:02d}:00" for day in dates for h in range(24)],
+            "temperature_2m": temps,
+            "apparent_temperature": [t - 2 for t in temps],
+            "precipitation_probability": [rnd.randint(0, 100) for _ in range(hours)],
+            "wind_speed_10m": [round(rnd.uniform(0, 30), 1) for _ in range(hours)]
+        },
+        "daily": {
+            "time": dates,
+            "sunrise": [f"{day}T05:{rnd.randint(0, 59):02d}" for day in dates],
+            "sunset": [f"{day}T19:{rnd.randint(0, 59):02d}" for day in dates]
+        }
+    }
+
+def open_meteo_app(config: StubConfig) -> web.Application:
+    async def forecast(request):
+        if await config.delay("open_meteo"):
+            return web.json_response({"error": True, "reason": "stub error"}, status=503)
+        lats = [float(x) for x in request.query["latitude"].split(",")]
+        lons = [float(x) for x in request.query["longitude"].split(",")]
+        days = int(request.query.get("forecast_days", 1))
+        data = [_forecast(lat, lon, days) for lat, lon in zip(lats, lons)]
+        return web.json_response(data if len(data) > 1 else data[0])
+    app = web.Application()
+    app.router.add_get("/v1/forecast", forecast)
+    return app
+
+def geoapify_app(config: StubConfig) -> web.Application:
+    async def reverse(request):
+        if await config.delay("geoapify"):
+            return web.json_response({"error": "stub error"}, status=503)
+        lon = float(request.query["lon"])
+        offset = round(lon / 15)
+        sign = "-" if offset < 0 else "+"
+        return web.json_response({"features": [{"properties": {"timezone": {
+            "name": None,
+            "offset_STD": f"{sign}{abs(offset):02d}:00"
+        }}}]})
+    app = web.Application()
+    app.router.add_get("/v1/geocode/reverse", reverse)
+    return app
+
+def openweathermap_app(config: StubConfig) -> web.Application:
+    async def direct(request):
+        if await config.delay("openweathermap"):
+            return web.json_response({"message": "stub error"}, status=503)
+        rnd = random.Random(request.query["q"])
+        return web.json_response([{"name": request.query["q"],
+                                   "lat": rnd.uniform(-60, 60), "lon": rnd.uniform(-180, 180)}])
+    app = web.Application()
+    app.router.add_get("/geo/1.0/direct", direct)
+    return app
+
+def telegram_app(config: StubConfig) -> web.Application:
+    counter = iter(range(1, 10**12))
+
+    async def method(request):
+        failed = await config.delay("telegram")
+        data = await request.post()
+        if failed:
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        chat_id = int(data.get("chat_id", 0))
+        message = {
+            "message_id": next(counter),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}
+        }
+        name = request.match_info["method"].lower()
+        if name == "sendphoto":
+            photo = data.get("photo")
+            file_id = photo if isinstance(photo, str) else f"stub-{message['message_id']}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id,
+                                 "width": 1280, "height": 720}]
+            message["caption"] = data.get("caption")
+        else:
+            message["text"] = data.get("text")
+        return web.json_response({"ok": True, "result": message})
+    app = web.Application(client_max_size=50 * 2**20)
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+async def start_stub(app: web.Application):
+    """
+    Starts the app on a free local port, returns its runner and base url
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
@@ -0,0 +1,73 @@
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+    After 'threshold' consecutive failures the circuit opens and calls fail at once
+    for 'reset_timeout' seconds; then a single trial call is let through,
+    which closes the circuit on success or opens it again on failure.
+    """
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial = False
+
+    def allow(self) -> bool:
+        # Whether a call may be made now
+        if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._trial = False
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            log.info(f"Circuit {self.name} closed")
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            if self.state == CLOSED:
+                log.warning(f"Circuit {self.name} opened after {self.failures} failures")
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+
+    async def call(self, func, is_failure=lambda e: True):
+        """
+        Awaits 'func()' if the circuit allows it, raises CircuitOpenError otherwise.
+        Exceptions for which 'is_failure' is false (e.g. bad requests) don't count as failures.
+        """
+        if not self.allow():
+            raise CircuitOpenError(f"Circuit {self.name} is open")
+        try:
+            result = await func()
+        except BaseException as e:
+            if isinstance(e, Exception) and is_failure(e):
+                self.record_failure()
+            elif self.state == HALF_OPEN:
+                self._trial = False # e.g. cancelled, let another call try
+            raise
+        self.record_success()
+        return result
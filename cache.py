@@ -0,0 +1,93 @@
+import asyncio
+from collections import OrderedDict
+import time
+
+class TTLCache:
+    """
+    Mapping with bounded size and per-entry expiry.
+    When the cache is full, the least recently used entry is evicted.
+    Keeps hit/miss counters.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[0] <= time.time():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, expires_at: float = None):
+        """
+        Stores the value until 'expires_at' (unix time) or for 'ttl' seconds by default
+        """
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None or item[0] <= time.time():
+            return default
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > time.time()
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight,
+    callers with its key wait for its result instead of starting their own.
+    """
+    def __init__(self):
+        self.shared = 0
+        self._calls = {} # key -> future
+
+    async def do(self, key, func):
+        """
+        Returns the result of 'func()' (a coroutine function) or of the call already in flight.
+        A cancelled caller doesn't cancel the call for the others.
+        """
+        return await asyncio.shield(self.start(key, func))
+
+    def start(self, key, func) -> asyncio.Future:
+        # Starts the call unless one is in flight, returns its future
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.shared += 1
+        return future
+
+    def _done(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception() # retrieved, even if all callers were cancelled
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
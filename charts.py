@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import hashlib
+import io
+import os
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', os.cpu_count() or 1))
+_chart_pool = None
+
+# Colors of matplotlib's 'dark_background' style, applied explicitly
+# so that rendering doesn't touch pyplot's global state
+FONT_SIZE = 14
+BACKGROUND = 'black'
+FOREGROUND = 'white'
+
+# Charts are drawn at CHART_DPI dots per inch of a 16x9 inch figure;
+# e.g. 60 gives lighter 960x540 images instead of 1600x900
+CHART_DPI = int(os.getenv('CHART_DPI', 100))
+# Precipitation probability is shown only if it reaches this value
+PRECIPITATION_THRESHOLD = 5
+
+def _style_axis(ax):
+    ax.set_facecolor(BACKGROUND)
+    ax.tick_params(colors=FOREGROUND, labelsize=FONT_SIZE)
+    for spine in ax.spines.values():
+        spine.set_color(FOREGROUND)
+
+def _legend(ax, graphs: list):
+    legend = ax.legend(graphs, [graph.get_label() for graph in graphs], loc="lower left",
+                       fontsize=FONT_SIZE, facecolor=BACKGROUND, edgecolor=FOREGROUND)
+    for text in legend.get_texts():
+        text.set_color(FOREGROUND)
+    return legend
+
+class ChartTemplate:
+    """
+    Figure with axes, styling and legends built once for charts of 'hours' hours.
+    Each chart only swaps in the hourly series, so rendering costs little more than drawing.
+    Margins are fixed (rather than computed for each image) to fit all y-axes.
+    """
+    def __init__(self, hours: int):
+        # matplotlib is heavy to import, so it's loaded only by processes that render
+        from matplotlib.figure import Figure
+        self.hours = hours
+        x = list(range(hours))
+        zeros = [0] * hours
+        self.fig = Figure(figsize=(16,9), facecolor=BACKGROUND)
+        self.ax1 = ax1 = self.fig.subplots()
+        _style_axis(ax1)
+        self.temp, = ax1.plot(x, zeros, 's-',
+                              markersize=5, color='cyan', label = 'temperature', zorder=2)
+        self.apparent_temp, = ax1.plot(x, zeros, 'D-',
+                                       markersize=5, color='blueviolet', label = 'apparent temperature')
+        self.ax2 = ax2 = ax1.twinx()
+        _style_axis(ax2)
+        self.wind, = ax2.plot(x, zeros, 'o-',
+                              markersize=5, color='lime', label = 'wind')
+        ax1.grid(color=FOREGROUND)
+        # at most ~24 ticks, labelled by hour of the day
+        step = next(step for step in (1, 2, 3, 6, 12, 24) if hours / step <= 24 or step == 24)
+        ax1.set_xticks(x[::step], [str(i % 24) for i in x[::step]])
+        ax1.set_xlabel('Hours', color=FOREGROUND, fontsize=FONT_SIZE)
+        ax1.set_xlim(-0.5, hours - 0.5)
+        ax1.set_ylabel("°C", color=FOREGROUND, fontsize=FONT_SIZE)
+        ax2.set_ylabel("km/h", color=FOREGROUND, fontsize=FONT_SIZE)
+        ax2.spines['left'].set_position(('outward', 50))
+        ax2.yaxis.set_label_position('left')
+        ax2.yaxis.set_ticks_position('left')
+        self.ax3 = ax3 = ax1.twinx()
+        _style_axis(ax3)
+        self.bars = ax3.bar(x, zeros, color='coral', alpha=0.5, label="precipitation prob.")
+        ax3.set_ylabel("%", color=FOREGROUND, fontsize=FONT_SIZE)
+        ax3.spines['left'].set_position(('outward', 100))
+        ax3.yaxis.set_label_position('left')
+        ax3.yaxis.set_ticks_position('left')
+        graphs = [self.temp, self.apparent_temp, self.wind]
+        self.legend = _legend(ax1, graphs)
+        self.legend_precipitation = _legend(ax1, graphs + [self.bars])
+
+    def render(self, hourly: dict, dpi: int = CHART_DPI) -> bytes:
+        self.temp.set_ydata(hourly["temp"])
+        self.apparent_temp.set_ydata(hourly["apparent_temp"])
+        self.wind.set_ydata(hourly["wind"])
+        precipitation = max(hourly["precipitation_prob"]) >= PRECIPITATION_THRESHOLD
+        if precipitation:
+            for bar, height in zip(self.bars, hourly["precipitation_prob"]):
+                bar.set_height(height)
+        self.ax3.set_visible(precipitation)
+        self.ax1.legend_ = self.legend_precipitation if precipitation else self.legend
+        axes = (self.ax1, self.ax2, self.ax3) if precipitation else (self.ax1, self.ax2)
+        for ax in axes:
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+        self.fig.subplots_adjust(left=0.13 if precipitation else 0.1, right=0.99, bottom=0.08, top=0.98)
+        buffer = io.BytesIO()
+        self.fig.savefig(buffer, format="png", dpi=dpi, facecolor=BACKGROUND)
+        return buffer.getvalue()
+
+# Templates of the current (worker) process by number of hours
+_templates = {}
+
+def render_chart(hourly: dict, reuse: bool = True, dpi: int = CHART_DPI) -> bytes:
+    """
+    Draws hourly temperature, wind and precipitation probability
+    and returns the chart as PNG bytes.
+    Safe to run in parallel worker processes, each of which keeps its own templates;
+    with 'reuse' false the template is built from scratch and released right away.
+    """
+    hours = len(hourly["temp"])
+    if not reuse:
+        return ChartTemplate(hours).render(hourly, dpi)
+    template = _templates.get(hours)
+    if template is None:
+        template = _templates[hours] = ChartTemplate(hours)
+    return template.render(hourly, dpi)
+
+class ChartStore:
+    """
+    In-memory cache of rendered charts, bounded by their total size in bytes.
+    Each chart expires together with the forecast it was drawn from.
+    Least recently used charts are evicted, or moved to 'spill_dir' on disk if it's given.
+    """
+    def __init__(self, max_bytes: int, spill_dir: str = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._charts = OrderedDict() # key -> (expires_at, png)
+        self._spilled = {} # key -> (expires_at, path)
+        self._next_purge = 0.0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def get(self, key: str):
+        now = time.time()
+        item = self._charts.get(key)
+        if item is not None:
+            if item[0] > now:
+                self._charts.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self._discard(key)
+        elif key in self._spilled:
+            expires_at, path = self._spilled.pop(key)
+            try:
+                if expires_at > now:
+                    with open(path, "rb") as f:
+                        png = f.read()
+                    self.hits += 1
+                    self.set(key, png, expires_at)
+                    return png
+            except OSError:
+                pass
+            finally:
+                self._remove_file(path)
+        self.misses += 1
+        return None
+
+    def set(self, key: str, png: bytes, expires_at: float):
+        self._discard(key)
+        self._charts[key] = (expires_at, png)
+        self.size += len(png)
+        while self.size > self.max_bytes and len(self._charts) > 1:
+            old_key, (old_expires_at, old_png) = self._charts.popitem(last=False)
+            self.size -= len(old_png)
+            if self.spill_dir and old_expires_at > time.time():
+                self._spill(old_key, old_png, old_expires_at)
+
+    def _discard(self, key: str):
+        item = self._charts.pop(key, None)
+        if item is not None:
+            self.size -= len(item[1])
+
+    def _spill(self, key: str, png: bytes, expires_at: float):
+        now = time.time()
+        if now >= self._next_purge:
+            # expired files are removed at most once a minute
+            self._next_purge = now + 60
+            for old_key, (old_expires_at, old_path) in list(self._spilled.items()):
+                if old_expires_at <= now:
+                    del self._spilled[old_key]
+                    self._remove_file(old_path)
+        path = os.path.join(self.spill_dir, hashlib.sha1(key.encode()).hexdigest() + ".png")
+        try:
+            with open(path, "wb") as f:
+                f.write(png)
+            self._spilled[key] = (expires_at, path)
+        except OSError as e:
+            log.error(str(e))
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._charts) + len(self._spilled)
+
+def open_chart_pool():
+    global _chart_pool
+    _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+    log.info(f"Chart pool started with {CHART_WORKERS} workers")
+
+def close_chart_pool():
+    global _chart_pool
+    if _chart_pool is not None:
+        _chart_pool.shutdown(cancel_futures=True)
+        _chart_pool = None
+        log.info("Chart pool stopped")
+
+async def render_chart_async(hourly: dict) -> bytes:
+    """
+    Renders the chart in the worker pool without blocking the event loop
+    """
+    if _chart_pool is None:
+        raise RuntimeError("Chart pool is not started")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_chart_pool, render_chart, hourly)
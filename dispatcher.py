@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import time
+import traceback
+from metrics import NOTIFICATION_LAG
+
+log = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 1440
+# Number of missed minutes to catch up on if the event loop was stalled
+MAX_CATCH_UP = 5
+
+def utc_minute(h: int, m: int, offset: int) -> int:
+    # UTC minute of the day corresponding to local time h:m in timezone 'offset' (minutes w.r.t. GMT)
+    return (h * 60 + m - offset) % MINUTES_PER_DAY
+
+class NotificationDispatcher:
+    """
+    Timing wheel with a slot of subscribers for every UTC minute of the day.
+    Wakes up once a minute, passes the chat_ids of the current slot to 'prepare'
+    (which returns the items to be sent, e.g. user rows with prefetched forecasts)
+    and calls 'notify' for every item, running at most 'concurrency' of them at once.
+    If 'stage' is given, the slot due in 'lookahead' minutes is prepared in advance
+    and 'stage' is called for its items, so that only sending remains at the scheduled time;
+    'staged' splits chat_ids into items staged this way, which are sent right away,
+    and the remaining chat_ids, which are prepared.
+    """
+    def __init__(self, prepare, notify, concurrency: int = 50, stage=None, lookahead: int = 0,
+                 staged=None):
+        self.prepare = prepare
+        self.notify = notify
+        self.concurrency = concurrency
+        self.stage = stage
+        self.lookahead = lookahead
+        self.staged = staged
+        self._slots = [set() for _ in range(MINUTES_PER_DAY)]
+        self._minute_of = {} # chat_id -> minute
+        self._task = None
+        self._running = set()
+
+    def add(self, chat_id, minute: int):
+        self.remove(chat_id)
+        self._slots[minute].add(chat_id)
+        self._minute_of[chat_id] = minute
+
+    def remove(self, chat_id):
+        minute = self._minute_of.pop(chat_id, None)
+        if minute is not None:
+            self._slots[minute].discard(chat_id)
+
+    def due(self, minute: int) -> list:
+        return list(self._slots[minute])
+
+    async def select(self, minute: int, planned: float) -> list:
+        # chat_ids to be notified at given minute
+        return self.due(minute)
+
+    async def upcoming(self, minute: int) -> list:
+        # chat_ids expected to be notified at given minute, for prefetching
+        return self.due(minute)
+
+    def __len__(self):
+        return len(self._minute_of)
+
+    def start(self, since: float = None):
+        """
+        Starts the wheel. Slots due since 'since' (unix time, e.g. process start),
+        at most MAX_CATCH_UP of them, are dispatched right away.
+        """
+        self._task = asyncio.create_task(self._run(since))
+        log.info(f"Notification dispatcher started with {len(self)} subscribers")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self, since: float = None):
+        last = int((time.time() if since is None else since) // 60)
+        while True:
+            now = int(time.time() // 60)
+            for tick in range(max(last + 1, now - MAX_CATCH_UP + 1), now + 1):
+                self._spawn(self.dispatch(tick % MINUTES_PER_DAY, planned=tick * 60))
+            if self.stage is not None and self.lookahead > 0 and now > last:
+                self._spawn(self.prefetch((now + self.lookahead) % MINUTES_PER_DAY))
+            last = max(last, now)
+            await asyncio.sleep(60 - time.time() % 60)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_bounded(self, func, items: list, semaphore: asyncio.Semaphore = None):
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                try:
+                    await func(item)
+                except Exception:
+                    log.error(traceback.format_exc())
+
+        await asyncio.gather(*[bounded(item) for item in items])
+
+    async def prefetch(self, minute: int):
+        """
+        Prepares and stages notifications of the slot ahead of time.
+        Whatever isn't staged in time is prepared on demand when the slot is due.
+        """
+        try:
+            chat_ids = await self.upcoming(minute)
+            if not chat_ids:
+                return
+            items = await self.prepare(chat_ids)
+        except Exception:
+            log.error(traceback.format_exc())
+            return
+        await self._run_bounded(self.stage, items)
+        log.info(f"Prefetched {len(items)} notifications for minute {minute}")
+
+    async def dispatch(self, minute: int, planned: float = None):
+        """
+        Sends notifications to the users of the slot.
+        'planned' is the scheduled unix time, used to measure delivery lag.
+        """
+        if planned is None:
+            planned = time.time()
+        try:
+            chat_ids = await self.select(minute, planned)
+        except Exception:
+            log.error(traceback.format_exc())
+            return
+        await self.deliver(minute, planned, chat_ids)
+
+    async def deliver(self, minute: int, planned: float, chat_ids: list):
+        """
+        Sends notifications of the slot to given users: staged ones at once,
+        the rest once they are prepared
+        """
+        if not chat_ids:
+            return
+        ready, chat_ids = self.staged(chat_ids) if self.staged is not None else ([], chat_ids)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def notify(item):
+            await self.notify(item)
+            NOTIFICATION_LAG.observe(time.time() - planned)
+
+        async def prepare_and_notify() -> int:
+            if not chat_ids:
+                return 0
+            try:
+                items = await self.prepare(chat_ids)
+            except Exception:
+                log.error(traceback.format_exc())
+                return 0
+            await self._run_bounded(notify, items, semaphore)
+            return len(items)
+
+        _, prepared = await asyncio.gather(self._run_bounded(notify, ready, semaphore),
+                                           prepare_and_notify())
+        log.info(f"Dispatched {len(ready) + prepared} notifications for minute {minute} ({len(ready)} staged)")
+
+# Namespace (first key) of the advisory locks used for sharding;
+# the second key is shard's number, or MEMBERSHIP for replicas' presence
+SHARD_LOCK_NAMESPACE = 7160002
+MEMBERSHIP = -1
+
+class ShardedDispatcher(NotificationDispatcher):
+    """
+    Dispatcher for running several replicas of the bot.
+    Users are split into 'shards' by chat_id; every replica owns a fair share of shards,
+    holding a PostgreSQL advisory lock for each of them on a dedicated connection.
+    Once a replica is gone, its locks are released and the shards are picked up by the others.
+    Due users are taken from the database rather than from the in-memory wheel, through 'claim',
+    which marks them as notified for the slot, so a user is never notified twice,
+    and through 'peek' (which doesn't mark them) for prefetching.
+    """
+    def __init__(self, prepare, notify, claim, acquire, shards: int, concurrency: int = 50,
+                 stage=None, lookahead: int = 0, staged=None, peek=None):
+        super().__init__(prepare, notify, concurrency, stage, lookahead, staged)
+        self.claim = claim
+        self.peek = peek
+        self.acquire = acquire
+        self.shards = shards
+        self.owned = set()
+        self._conn = None
+        self._holder = None
+        self._lock = asyncio.Lock()
+
+    # subscribers live in the database, which is shared by all replicas
+    def add(self, chat_id, minute: int):
+        pass
+
+    def remove(self, chat_id):
+        pass
+
+    async def _connect(self):
+        self._holder = self.acquire()
+        self._conn = await self._holder.__aenter__()
+        await self._conn.execute("SELECT pg_advisory_lock_shared($1, $2);", SHARD_LOCK_NAMESPACE, MEMBERSHIP)
+
+    async def _disconnect(self):
+        self.owned = set()
+        if self._holder is not None:
+            holder, self._holder, self._conn = self._holder, None, None
+            try:
+                await holder.__aexit__(None, None, None)
+            except Exception as e:
+                log.error(str(e))
+
+    async def rebalance(self) -> set:
+        """
+        Takes free shards or releases extra ones, so that every live replica
+        owns about the same number of shards. Returns the shards taken.
+        """
+        gained = set()
+        async with self._lock:
+            try:
+                if self._conn is None:
+                    await self._connect()
+                replicas = await self._conn.fetchval("""
+                SELECT count(*) FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = $1 AND objid = $2 AND objsubid = 2 AND granted;
+                """, SHARD_LOCK_NAMESPACE, MEMBERSHIP & 0xFFFFFFFF)
+                target = -(-self.shards // max(replicas, 1))
+                for shard in sorted(self.owned)[target:]:
+                    await self._conn.execute("SELECT pg_advisory_unlock($1, $2);", SHARD_LOCK_NAMESPACE, shard)
+                    self.owned.discard(shard)
+                for shard in range(self.shards):
+                    if len(self.owned) >= target:
+                        break
+                    if shard not in self.owned and await self._conn.fetchval(
+                            "SELECT pg_try_advisory_lock($1, $2);", SHARD_LOCK_NAMESPACE, shard):
+                        self.owned.add(shard)
+                        gained.add(shard)
+            except Exception:
+                log.error(traceback.format_exc())
+                # locks are lost together with the connection
+                await self._disconnect()
+                gained = set()
+        return gained
+
+    async def select(self, minute: int, planned: float) -> list:
+        gained = await self.rebalance()
+        if gained:
+            # slots of these shards may have been missed while they were changing hands
+            # (claims are idempotent, so already notified users are skipped)
+            tick = int(planned // 60)
+            for past in range(tick - MAX_CATCH_UP + 1, tick):
+                self._spawn(self.catch_up(past, sorted(gained)))
+        if not self.owned:
+            return []
+        return await self.claim(minute, planned, sorted(self.owned), self.shards) or []
+
+    async def catch_up(self, tick: int, shards: list):
+        # Notifies users of given shards due at the past minute 'tick' (since the epoch)
+        minute, planned = tick % MINUTES_PER_DAY, tick * 60
+        try:
+            chat_ids = await self.claim(minute, planned, shards, self.shards) or []
+        except Exception:
+            log.error(traceback.format_exc())
+            return
+        await self.deliver(minute, planned, chat_ids)
+
+    async def upcoming(self, minute: int) -> list:
+        # users of currently owned shards; ownership may change before the slot is due
+        if self.peek is None or not self.owned:
+            return []
+        return await self.peek(minute, sorted(self.owned), self.shards) or []
+
+    def start(self, since: float = None):
+        super().start(since)
+        log.info(f"Notifications are sharded into {self.shards} shards")
+
+    async def stop(self):
+        await super().stop()
+        await self._disconnect()
+
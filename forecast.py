@@ -0,0 +1,118 @@
+from datetime import datetime, timezone
+import numpy as np
+import time
+import warnings
+
+HOURS_PER_DAY = 24
+
+def _timestamps(times: list) -> np.ndarray:
+    # API's GMT times (e.g. '2024-06-01T04:12') as unix seconds, parsed in one pass
+    return np.array(times, dtype="datetime64[m]").astype("datetime64[s]").astype(np.int64)
+
+class Forecast:
+    """
+    Parsed Open-Meteo forecast of one grid cell, shared by all its users.
+    Hourly series are kept as compact NumPy arrays (one per variable, 'days' * 24 values
+    starting at 'start', GMT), sunrise and sunset as unix times, one per day.
+    """
+    __slots__ = ("updated", "current", "start", "temp", "apparent_temp",
+                 "precipitation_prob", "wind", "sunrise", "sunset")
+
+    def __init__(self, json: dict):
+        current = json["current"]
+        hourly = json["hourly"]
+        daily = json["daily"]
+        # time of the model's update, identifies the forecast (e.g. for charts)
+        self.updated = current["time"]
+        self.current = {
+            "temp": current["temperature_2m"],
+            "apparent_temp": current["apparent_temperature"],
+            "hum": current["relative_humidity_2m"],
+            "is_day": current["is_day"],
+            "wind_speed": current["wind_speed_10m"],
+            "clouds": current["cloud_cover"]
+        }
+        self.start = int(_timestamps(hourly["time"][:1])[0])
+        # missing values (null) become NaN
+        self.temp = np.array(hourly["temperature_2m"], dtype=np.float32)
+        self.apparent_temp = np.array(hourly["apparent_temperature"], dtype=np.float32)
+        self.precipitation_prob = np.array(hourly["precipitation_probability"], dtype=np.float32)
+        self.wind = np.array(hourly["wind_speed_10m"], dtype=np.float32)
+        self.sunrise = _timestamps(daily["sunrise"])
+        self.sunset = _timestamps(daily["sunset"])
+
+    @property
+    def days(self) -> int:
+        return len(self.temp) // HOURS_PER_DAY
+
+    def hourly(self, days: int = None) -> dict:
+        """
+        Hourly series of the first 'days' days (all by default), as views of the arrays
+        """
+        end = len(self.temp) if days is None else days * HOURS_PER_DAY
+        return {
+            "temp": self.temp[:end],
+            "apparent_temp": self.apparent_temp[:end],
+            "precipitation_prob": self.precipitation_prob[:end],
+            "wind": self.wind[:end]
+        }
+
+    def daily(self, offset: int = 0, now: float = None) -> list:
+        """
+        Summaries of the user's local days, given user's UTC offset in minutes,
+        from the current one on: temperature range, maximal wind speed,
+        precipitation probability peak and its local hour, sunrise and sunset (unix time or None).
+        Hours are laid out on a (local day, local hour) grid, so that days cut off
+        by the forecast's GMT bounds are summarized over the hours available;
+        following days with less than half of their hours are left out.
+        """
+        if now is None:
+            now = time.time()
+        shift = offset * 60
+        local = self.start + shift + np.arange(len(self.temp), dtype=np.int64) * 3600
+        day_of = local // 86400
+        first = max(int(day_of[0]), int((now + shift) // 86400))
+        days = int(day_of[-1]) - first + 1
+        if days <= 0:
+            return []
+        rows = day_of - first
+        hours = local % 86400 // 3600
+        inside = rows >= 0
+        rows, hours = rows[inside], hours[inside]
+
+        def grid(values: np.ndarray) -> np.ndarray:
+            result = np.full((days, HOURS_PER_DAY), np.nan, dtype=np.float32)
+            result[rows, hours] = values[inside]
+            return result
+
+        def per_day(times: np.ndarray) -> list:
+            # event times (e.g. sunrises) by local day, None if there's none in the forecast
+            result = [None] * days
+            for row, when in zip((times + shift) // 86400 - first, times):
+                if 0 <= row < days:
+                    result[row] = int(when)
+            return result
+
+        known = np.bincount(rows, minlength=days)
+        temp = grid(self.temp)
+        wind = grid(self.wind)
+        precipitation = np.nan_to_num(grid(self.precipitation_prob), nan=-1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # all-NaN days
+            temp_min = np.nanmin(temp, axis=1)
+            temp_max = np.nanmax(temp, axis=1)
+            wind_max = np.nanmax(wind, axis=1)
+        precipitation_peak = precipitation.argmax(axis=1)
+        precipitation_max = precipitation.max(axis=1).clip(0)
+        sunrise = per_day(self.sunrise)
+        sunset = per_day(self.sunset)
+        return [{
+            "date": datetime.fromtimestamp((first + day) * 86400, timezone.utc).date(),
+            "temp_min": round(float(temp_min[day]), 1),
+            "temp_max": round(float(temp_max[day]), 1),
+            "wind_max": round(float(wind_max[day]), 1),
+            "precipitation_max": int(precipitation_max[day]),
+            "precipitation_peak_hour": int(precipitation_peak[day]),
+            "sunrise": sunrise[day],
+            "sunset": sunset[day]
+        } for day in range(days) if day == 0 or known[day] >= HOURS_PER_DAY // 2]
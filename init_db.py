@@ -1,22 +1,122 @@
-from utils import with_db, db_exists
+from utils import acquire, open_db_pool, close_db_pool, OFFSET_MINUTES_SQL
+import asyncio
 import logging
 
 log = logging.getLogger(__name__)
 
-@with_db
-def init_db(cur):
-    if not db_exists("weatherbot"):
-        query = """
-        CREATE TABLE weatherbot (
-            chat_id VARCHAR(20) NOT NULL PRIMARY KEY,
-            lat FLOAT NOT NULL,
-            lon FLOAT NOT NULL,
-            tz_offset SMALLINT NOT NULL,
-            notify VARCHAR(5)
-        );
-        """
-        cur.execute(query)
-        log.info("Database created")
+# Key of the advisory lock which keeps concurrently starting bots from migrating at once
+MIGRATION_LOCK = 7160001
+BACKFILL_BATCH = 1000
+
+async def backfill_notify_minutes(conn):
+    """
+    Fills notification times as local and UTC minutes of the day
+    in small batches, each in its own transaction, so the table is never locked for long
+    """
+    while True:
+        async with conn.transaction():
+            result = await conn.execute(f"""
+            WITH batch AS (
+                SELECT chat_id FROM weatherbot
+                WHERE notify IS NOT NULL AND notify_local IS NULL
+                LIMIT {BACKFILL_BATCH}
+                FOR UPDATE SKIP LOCKED
+            ), local AS (
+                SELECT w.chat_id,
+                       split_part(w.notify, ':', 1)::int * 60 + split_part(w.notify, ':', 2)::int AS minute,
+                       {OFFSET_MINUTES_SQL} AS offset_minutes
+                FROM weatherbot w JOIN batch USING (chat_id)
+            )
+            UPDATE weatherbot w
+            SET notify_local = local.minute,
+                notify_minute = ((local.minute - local.offset_minutes) % 1440 + 1440) % 1440
+            FROM local WHERE w.chat_id = local.chat_id;
+            """)
+        if result.split()[-1] == "0":
+            break
+
+# Versioned schema changes, applied in order and recorded in 'schema_version'.
+# Each step is either SQL run in one transaction or a coroutine managing its own transactions.
+MIGRATIONS = [
+    (1, "create users table", """
+    CREATE TABLE IF NOT EXISTS weatherbot (
+        chat_id VARCHAR(20) NOT NULL PRIMARY KEY,
+        lat FLOAT NOT NULL,
+        lon FLOAT NOT NULL,
+        tz_offset SMALLINT NOT NULL,
+        notify VARCHAR(5)
+    );
+    ALTER TABLE weatherbot ADD COLUMN IF NOT EXISTS tz VARCHAR(64);
+    """),
+    (2, "create geocoding cache", """
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        city TEXT NOT NULL PRIMARY KEY,
+        lat FLOAT,
+        lon FLOAT,
+        tz_offset SMALLINT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    ALTER TABLE geocode_cache ADD COLUMN IF NOT EXISTS tz VARCHAR(64);
+    """),
+    (3, "compact typed columns", """
+    ALTER TABLE weatherbot ALTER COLUMN chat_id TYPE BIGINT USING chat_id::bigint;
+    ALTER TABLE weatherbot ADD COLUMN notify_local SMALLINT;
+    ALTER TABLE weatherbot ADD COLUMN notify_minute SMALLINT;
+    CREATE INDEX weatherbot_notify_minute ON weatherbot (notify_minute) WHERE notify_minute IS NOT NULL;
+    """),
+    (4, "backfill notification minutes", backfill_notify_minutes),
+    (5, "drop notification time strings", """
+    ALTER TABLE weatherbot DROP COLUMN notify;
+    """),
+    (6, "notification claims", """
+    ALTER TABLE weatherbot ADD COLUMN notified_at TIMESTAMPTZ;
+    """),
+    (7, "shared FSM storage", """
+    CREATE TABLE fsm_state (
+        key TEXT NOT NULL PRIMARY KEY,
+        state TEXT,
+        data JSONB NOT NULL DEFAULT '{}'
+    );
+    """),
+]
+
+async def init_db():
+    """
+    Brings the database schema to the latest version
+    """
+    async with acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1);", MIGRATION_LOCK)
+        try:
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """)
+            applied = {row[0] for row in await conn.fetch("SELECT version FROM schema_version;")}
+            for version, name, step in MIGRATIONS:
+                if version in applied:
+                    continue
+                if isinstance(step, str):
+                    async with conn.transaction():
+                        await conn.execute(step)
+                        await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2);",
+                                           version, name)
+                else:
+                    await step(conn)
+                    await conn.execute("INSERT INTO schema_version (version, name) VALUES ($1, $2);",
+                                       version, name)
+                log.info(f"Database migrated to version {version}: {name}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1);", MIGRATION_LOCK)
+
+async def main():
+    await open_db_pool()
+    try:
+        await init_db()
+    finally:
+        await close_db_pool()
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    asyncio.run(main())
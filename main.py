@@ -1,32 +1,55 @@
+import time
+# startup time is measured from here, before the heavy imports
+STARTED_AT = time.time()
 from utils import (get_loc_by_city, get_offset_by_loc, add_user,
-                   delete_user, get_user, make_forecast, clear_graphs,
-                   get_my_offset, with_db)
+                   delete_user, get_user, get_users, make_forecast,
+                   prefetch_forecasts, load_users, refresh_notify_minutes,
+                   claim_due_users, peek_due_users, acquire, open_http_session, close_http_session,
+                   open_db_pool, close_db_pool)
 from init_db import init_db
+from charts import open_chart_pool, close_chart_pool
+from dispatcher import NotificationDispatcher, ShardedDispatcher, utc_minute
+from storage import PostgresStorage
+from timezones import offset_minutes
+from send_queue import SendQueue, INTERACTIVE, SCHEDULED
+from cache import TTLCache
+from metrics import STAGE_SECONDS, Callback, start_metrics_server
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.enums.parse_mode import ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, FSInputFile
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, BufferedInputFile
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import os
 import sys
 from dotenv import find_dotenv, load_dotenv
 import logging
 load_dotenv( find_dotenv() )
 
-scheduler = AsyncIOScheduler()
-
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv('KEY_BOT')
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-
-my_offset = get_my_offset()
+# Bot API server can be replaced with a local one (e.g. for benchmarks)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+# FSM state is kept in memory, or in the database to be shared by several replicas
+if os.getenv('FSM_STORAGE', 'memory') == 'postgres':
+    dp = Dispatcher(storage=PostgresStorage())
+else:
+    dp = Dispatcher()
+send_queue = SendQueue(rate=float(os.getenv('SEND_RATE', 30)),
+                       per_chat_rate=float(os.getenv('SEND_RATE_PER_CHAT', 1)),
+                       workers=int(os.getenv('SEND_WORKERS', 8)))
 
 # Text and keyboard used to start registration process.
 # Defined globally, as they are referred to by multiple functions.
@@ -49,9 +72,17 @@ class UserPrefs(StatesGroup):
     coords = State()
     notify_time = State()
 
-async def get_forecast(chat_id: str):
-    # Generates forecast text
-    data = get_user(chat_id)
+# Telegram's limit of photo captions, in UTF-16 code units
+CAPTION_LIMIT = 1024
+
+def caption_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+async def get_forecast(chat_id: int, data=None):
+    # Generates forecast text; user's data is loaded from the database unless given
+    if data is None:
+        with STAGE_SECONDS.time(stage="db"):
+            data = await get_user(chat_id)
     if data is None:
         response = {
             "status": "not OK",
@@ -67,8 +98,9 @@ async def get_forecast(chat_id: str):
             }
             return response
         else:
+            chart = forecast["chart"]
             forecast = forecast["data"]
-            precipitation_prob = max(forecast["hourly"]["precipitation_prob"])
+            precipitation_prob = forecast["daily"][0]["precipitation_max"]
             forecast_text = f"""
 temperature🌡️: {forecast["current"]["temp"]} °C 
 apparent temperature🌡️🤔: {forecast["current"]["apparent_temp"]} °C
@@ -84,15 +116,43 @@ precipitation🌧️🌨️ probability: {precipitation_prob} %"""
 sunrise🕑: {forecast["sunrise"]}
 sunset🕙: {forecast["sunset"]}     
                 """
+            # summaries of the following days, if the forecast is for several days,
+            # as many as fit into the caption
+            forecast_text = forecast_text.rstrip()
+            separator = "\n\n"
+            for day in forecast["daily"][1:]:
+                line = separator + f"""{day["date"]:%a %d.%m}📅: {day["temp_min"]}..{day["temp_max"]} °C, wind up to {day["wind_max"]} km/h, precipitation {day["precipitation_max"]} %"""
+                if caption_length(forecast_text + line) > CAPTION_LIMIT:
+                    break
+                forecast_text += line
+                separator = "\n"
             response = {
                 "status": "OK",
-                "data": forecast_text
+                "data": forecast_text,
+                "chart": chart
             }
             return response
 
+Callback("weatherbot_send_queue_depth", "Telegram requests waiting to be sent",
+         lambda: send_queue.stats()["depth"])
+
+# Telegram's file_ids of already uploaded charts, keyed by chart's location cell
+# and forecast time, so that identical images are not uploaded again
+chart_file_ids = TTLCache(maxsize=int(os.getenv('FILE_ID_CACHE_SIZE', 100000)), ttl=86400)
+
+def chart_photo(chart: dict):
+    file_id = chart_file_ids.get(chart["key"])
+    if file_id is None:
+        return BufferedInputFile(chart["data"], filename="forecast.png")
+    return file_id
+
+def remember_chart(chart: dict, message: Message):
+    if message.photo:
+        chart_file_ids.set(chart["key"], message.photo[-1].file_id)
+
 @dp.message(Command('forecast'))
 async def forecast_command(message: Message):
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
     response = await get_forecast(chat_id)
     if response["status"] != "OK":
         if response["info"] == "user_not_found":
@@ -101,71 +161,140 @@ async def forecast_command(message: Message):
             await message.answer("Something went wrong☹️️")
             log.error(response["info"])
     else:
-        await message.reply_photo(
-            photo= FSInputFile(path=os.path.abspath(os.path.join("graphs", f"{chat_id}.png"))),
+        sent = await send_queue.send(chat_id, lambda: message.reply_photo(
+            photo= chart_photo(response["chart"]),
             caption= response["data"]
-        )
+        ), INTERACTIVE)
+        remember_chart(response["chart"], sent)
 
-async def notify_user(chat_id: str):
+async def prepare_notifications(chat_ids: list) -> list:
     """
-    This function is used to assign a daily forecast task via apscheduler
+    Loads users due for daily forecast and fetches their forecasts in batched API requests
     """
-    response = await get_forecast(chat_id)
+    users = await get_users(chat_ids) or []
+    await prefetch_forecasts([(user.lat, user.lon) for user in users])
+    return users
+
+# Forecasts prepared ahead of the scheduled time, keyed by chat_id, along with the users
+NOTIFY_LOOKAHEAD = int(os.getenv('NOTIFY_LOOKAHEAD', 2))
+staged_forecasts = TTLCache(maxsize=int(os.getenv('STAGED_CACHE_SIZE', 50000)),
+                            ttl=NOTIFY_LOOKAHEAD * 60 + 120)
+
+async def stage_notification(user):
+    """
+    Makes user's daily forecast (text and chart) before it's due
+    """
+    response = await get_forecast(user.chat_id, user)
+    if response["status"] == "OK":
+        staged_forecasts.set(user.chat_id, (user, response))
+
+def staged_users(chat_ids: list) -> tuple:
+    """
+    Splits chat_ids into users with a staged forecast, which can be sent right away,
+    and chat_ids of the rest
+    """
+    users, rest = [], []
+    for chat_id in chat_ids:
+        staged = staged_forecasts.get(chat_id)
+        if staged is None:
+            rest.append(chat_id)
+        else:
+            users.append(staged[0])
+    return users, rest
+
+async def notify_user(chat_id: int, data=None):
+    """
+    Sends daily forecast to the user, made in advance if it was staged
+    """
+    staged = staged_forecasts.pop(chat_id)
+    if staged is not None:
+        response = staged[1]
+    else:
+        response = await get_forecast(chat_id, data)
     if response["status"] != "OK":
-        await bot.send_message(chat_id=int(chat_id), text="Couldn't make a daily forecast☹️️")
+        await send_queue.send(chat_id, lambda: bot.send_message(chat_id=chat_id,
+                                                                text="Couldn't make a daily forecast☹️️"), SCHEDULED)
         log.error(response["info"])
     else:
-        await bot.send_photo(chat_id=int(chat_id),
-                             photo=FSInputFile(path=os.path.abspath(os.path.join("graphs", f"{chat_id}.png"))),
+        sent = await send_queue.send(chat_id, lambda: bot.send_photo(chat_id=chat_id,
+                             photo=chart_photo(response["chart"]),
                              caption=response["data"]
-                             )
+                             ), SCHEDULED)
+        remember_chart(response["chart"], sent)
+
+# With NOTIFY_SHARDS set, notifications are split between all running replicas
+NOTIFY_SHARDS = int(os.getenv('NOTIFY_SHARDS', 0))
+if NOTIFY_SHARDS:
+    dispatcher = ShardedDispatcher(prepare=prepare_notifications,
+                                   notify=lambda user: notify_user(user.chat_id, user),
+                                   claim=claim_due_users, peek=peek_due_users, acquire=acquire,
+                                   shards=NOTIFY_SHARDS,
+                                   concurrency=int(os.getenv('NOTIFY_CONCURRENCY', 50)),
+                                   stage=stage_notification, lookahead=NOTIFY_LOOKAHEAD,
+                                   staged=staged_users)
+else:
+    dispatcher = NotificationDispatcher(prepare=prepare_notifications,
+                                        notify=lambda user: notify_user(user.chat_id, user),
+                                        concurrency=int(os.getenv('NOTIFY_CONCURRENCY', 50)),
+                                        stage=stage_notification, lookahead=NOTIFY_LOOKAHEAD,
+                                        staged=staged_users)
+if not NOTIFY_SHARDS:
+    # sharded subscribers live only in the database
+    Callback("weatherbot_subscribers", "Users receiving daily forecasts", lambda: len(dispatcher))
+
+# chat_ids registered or deleted by handlers while subscribers are being loaded;
+# rows of these users read by the loader may be outdated, so it skips them
+changed_while_loading = None
+
+def mark_changed(chat_id: int):
+    if changed_while_loading is not None:
+        changed_while_loading.add(chat_id)
+
+def unsubscribe(chat_id: int):
+    mark_changed(chat_id)
+    dispatcher.remove(chat_id)
+    staged_forecasts.pop(chat_id)
 
 @dp.message(Command('deleteme'))
 async def delete_command(message: Message):
-    chat_id = str(message.chat.id)
-    data = get_user(chat_id)
+    chat_id = message.chat.id
+    data = await get_user(chat_id)
     if data is None:
         await message.answer("I don't see you in my database🔍\nType /start to register")
     else:
-        delete_user(chat_id)
-        if data[-1]:
-            scheduler.remove_job(chat_id)
-        if os.path.isfile(os.path.join('graphs',f'{chat_id}.png')):
-            os.remove(os.path.join('graphs',f'{chat_id}.png'))
+        await delete_user(chat_id)
+        unsubscribe(chat_id)
         await message.answer("Deleted🗑")
 
 @dp.message(Command('updateme'))
 async def update_command(message: Message):
-    chat_id = str(message.chat.id)
-    data = get_user(chat_id)
+    chat_id = message.chat.id
+    data = await get_user(chat_id)
     if data is None:
         await message.answer("I don't see you in my database🔍\nType /start to register")
     else:
-        delete_user(chat_id)
-        if data[-1]:
-            scheduler.remove_job(chat_id)
-        if os.path.isfile(os.path.join('graphs',f'{chat_id}.png')):
-            os.remove(os.path.join('graphs',f'{chat_id}.png'))
+        await delete_user(chat_id)
+        unsubscribe(chat_id)
         await message.answer(text=start_text, reply_markup=kb_loc_options.as_markup())
 
 @dp.message(Command('changetime'))
 async def change_time_command(message: Message, state: FSMContext):
-    chat_id = str(message.chat.id)
-    data = get_user(chat_id)
+    chat_id = message.chat.id
+    data = await get_user(chat_id)
     if data is None:
         await state.clear()
         await message.answer("I don't see you in my database🔍\n Type /start to register")
     else:
-        delete_user(chat_id)
-        scheduler.remove_job(chat_id)
+        await delete_user(chat_id)
+        unsubscribe(chat_id)
         await state.set_state(UserPrefs.coords)
-        await state.update_data(coords=list(data[1:-1]))
+        await state.update_data(coords=[data.lat, data.lon, data.tz_offset, data.tz])
         await get_notify_time(message, state)
 
 @dp.message(CommandStart())
 async def start_command(message: Message):
-    chat_id = str(message.chat.id)
-    data = get_user(chat_id)
+    chat_id = message.chat.id
+    data = await get_user(chat_id)
     if data is None:
         await message.answer(text=start_text, reply_markup=kb_loc_options.as_markup())
     else:
@@ -190,7 +319,7 @@ async def handle_send_loc_2(message: Message, state: FSMContext):
             await handle_failure(message, state)
             log.error(offset["info"])
         else:
-            await state.update_data(coords = [lat, lon, offset["data"]])
+            await state.update_data(coords = [lat, lon, *offset["data"]])
             await get_notify_time(message, state)
     except Exception as e:
         await message.answer("Couldn't receive coordinates :c")
@@ -229,7 +358,7 @@ async def handle_send_manually_2(message: Message, state: FSMContext):
         lat, lon = [ float(num) for num in message.text.split(",")]
         offset_response = await get_offset_by_loc(lat,lon)
         if offset_response["status"] == "OK":
-            await state.update_data(coords = [lat, lon, offset_response["data"]])
+            await state.update_data(coords = [lat, lon, *offset_response["data"]])
             await get_notify_time(message, state)
         else:
             await message.answer("Something went wrong☹️")
@@ -288,46 +417,107 @@ You can use the following commands:
     """
     await message.answer(answer_text)
     await state.clear()
-    chat_id = str(message.chat.id)
+    chat_id = message.chat.id
+    mark_changed(chat_id)
     if data["notify_time"]:
         h,m = data["notify_time"].split(":")
         h,m = int(h), int(m)
-        offset = data["coords"][2]
-        h = ( h - offset + my_offset ) % 24
-        scheduler.add_job(notify_user, 'cron', hour=h, minute=m, id=chat_id, args=[chat_id])
-    add_user(chat_id, **data)
+        offset, tz = data["coords"][2:4]
+        dispatcher.add(chat_id, utc_minute(h, m, offset_minutes(tz, offset)))
+    await add_user(chat_id, **data)
     log.info("User inserted")
 
 @dp.message()
 async def reply_to_nonsense(message: Message):
     await message.answer("🤔")
 
-@with_db
-def init_notifications(cur):
+async def init_notifications():
+    """
+    This function is used to schedule daily forecasts
+    for all the users in the database
     """
-    This function is used to add daily forecast tasks
-    for all the users in the database via apscheduler
+    global changed_while_loading
+    start = time.perf_counter()
+    changed_while_loading = set()
+    try:
+        count = await load_users(lambda user: dispatcher.add(user.chat_id, user.notify_minute),
+                                 warm_cache=os.getenv('USER_CACHE_WARMUP', '1') == '1',
+                                 skip=changed_while_loading) or 0
+    finally:
+        changed_while_loading = None
+    log.info(f"Loaded {count} subscribers in {time.perf_counter() - start:.2f} s")
+
+async def start_notifications():
     """
-    query="""
-    SELECT chat_id, tz_offset, notify FROM weatherbot
-    WHERE notify IS NOT NULL;
+    Loads subscribers in the background while the bot already answers commands,
+    then starts the dispatcher, catching up on forecasts due since the process started.
+    Sharded dispatcher takes due users from the database, so nothing is loaded then.
     """
-    cur.execute(query)
-    users = cur.fetchall()
-    for user in users:
-        h,m = user[2].split(":")
-        h = int(h)
-        m = int(m)
-        h = (h - int(user[1]) + my_offset) % 24
-        scheduler.add_job(notify_user, 'cron', hour=h, minute=m, id=user[0], args=[user[0]])
+    if not NOTIFY_SHARDS:
+        await init_notifications()
+    dispatcher.start(since=STARTED_AT)
+
+async def refresh_notifications():
+    """
+    Every hour, shortly after it starts (when DST changes take effect),
+    recomputes notification times of all users and moves the changed ones on the wheel
+    """
+    while True:
+        await asyncio.sleep(3600 - time.time() % 3600 + 60)
+        for chat_id, minute in await refresh_notify_minutes() or []:
+            dispatcher.add(chat_id, minute)
+
+# Updates are received via webhook if WEBHOOK_URL is set, otherwise by polling.
+# Several replicas can only be run in webhook mode.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    log.info(f"Webhook server started on port {WEBHOOK_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+@dp.startup()
+async def on_startup():
+    log.info(f"Bot started in {time.time() - STARTED_AT:.2f} s")
 
 async def main():
-    init_db()
-    # clears all graphs at midnight w.r.t. GMT
-    scheduler.add_job(clear_graphs, 'cron', hour=my_offset, minute=0)
-    init_notifications()
-    scheduler.start()
-    await dp.start_polling(bot)
+    await open_db_pool()
+    await init_db()
+    await open_http_session()
+    open_chart_pool()
+    send_queue.start()
+    notifications_task = asyncio.create_task(start_notifications())
+    refresh_task = asyncio.create_task(refresh_notifications())
+    metrics_port = int(os.getenv('METRICS_PORT', 8000))
+    metrics_server = await start_metrics_server(metrics_port) if metrics_port else None
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        refresh_task.cancel()
+        notifications_task.cancel()
+        await asyncio.gather(notifications_task, return_exceptions=True)
+        await dispatcher.stop()
+        await send_queue.stop()
+        close_chart_pool()
+        await close_http_session()
+        await close_db_pool()
 
 if __name__ == '__main__':
     if sys.platform.startswith('win'):
@@ -0,0 +1,127 @@
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# All metrics, exported in Prometheus text format
+_registry = []
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    items = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {} # sorted labels -> value
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+class Callback:
+    """
+    Metric read from 'func' at scrape time, so it costs nothing on the hot path.
+    'func' returns a number or a dict of {label value: number}, labelled by 'label'.
+    """
+    def __init__(self, name: str, help: str, func, kind: str = "gauge", label: str = None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.kind = kind
+        self.label = label
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.func()
+        except Exception as e:
+            log.error(str(e))
+            return lines
+        if isinstance(value, dict):
+            for label_value, v in value.items():
+                lines.append(f"{self.name}{_format_labels(((self.label, label_value),))} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values = {} # sorted labels -> [bucket counts..., +Inf count, sum]
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts in self._values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {total}")
+        return lines
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(port: int):
+    """
+    Serves all metrics at http://0.0.0.0:<port>/metrics, returns the server's runner
+    """
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    log.info(f"Metrics are served on port {port}")
+    return runner
+
+# Time spent in each stage of making and sending a forecast:
+# db, fetch, parse (json), convert (to arrays), render, save, send
+STAGE_SECONDS = Histogram("weatherbot_stage_seconds", "Duration of forecast stages")
+UPSTREAM_ERRORS = Counter("weatherbot_upstream_errors_total", "Failed requests to upstream APIs")
+STALE_RESPONSES = Counter("weatherbot_stale_responses_total",
+                          "Last good upstream responses served because the upstream failed")
+NOTIFICATION_LAG = Histogram("weatherbot_notification_lag_seconds",
+                             "Delay of daily forecast delivery w.r.t. its scheduled time")
@@ -0,0 +1,154 @@
+from aiogram.exceptions import TelegramRetryAfter
+from collections import deque
+from cache import TTLCache
+from metrics import STAGE_SECONDS
+import asyncio
+import itertools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Priority classes: replies to users' commands always go before scheduled notifications
+INTERACTIVE = 0
+SCHEDULED = 1
+
+class TokenBucket:
+    """
+    Allows 'rate' events per second on average with bursts of up to 'capacity' events
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def delay(self) -> float:
+        # Seconds until a token is available
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._tokens -= 1
+
+class SendQueue:
+    """
+    Central queue of outbound Telegram requests.
+    Requests are sent by a fixed number of workers in priority order,
+    limited by a global and a per-chat token bucket.
+    When Telegram answers with RetryAfter, all sending is paused for
+    the requested time and the request is retried.
+    """
+    def __init__(self, rate: float = 30, per_chat_rate: float = 1, per_chat_burst: float = 3,
+                 workers: int = 8, max_retries: int = 3):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, rate)
+        # buckets of chats idle for a minute are full again, so they can be dropped
+        self._chat_buckets = TTLCache(maxsize=100000, ttl=60)
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._latencies = deque(maxlen=1000)
+
+    async def send(self, chat_id, request, priority: int = SCHEDULED):
+        """
+        Expects a function without arguments returning a coroutine,
+        so that the request can be repeated. Returns its result once sent.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._put((priority, next(self._seq), time.monotonic(), chat_id, request, future, 0))
+        return await future
+
+    def _put(self, item):
+        self._queue.put_nowait(item)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _send_delay(self) -> float:
+        # Seconds until anything may be sent, given the global bucket and a RetryAfter pause
+        return max(self._paused_until - time.monotonic(), self._bucket.delay())
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # the item is taken only once it can be sent, so that the most urgent one is chosen
+            while (delay := self._send_delay()) > 0:
+                await asyncio.sleep(delay)
+            item = await self._queue.get()
+            if self._send_delay() > 0:
+                # the token went to another worker meanwhile
+                self._put(item)
+                continue
+            priority, seq, enqueued, chat_id, request, future, attempt = item
+            if future.cancelled():
+                continue
+            chat_bucket = self._chat_bucket(chat_id)
+            delay = chat_bucket.delay()
+            if delay > 0:
+                # don't block the worker on a single chat
+                loop.call_later(delay, self._put, item)
+                continue
+            self._bucket.take()
+            chat_bucket.take()
+            try:
+                with STAGE_SECONDS.time(stage="send"):
+                    result = await request()
+            except TelegramRetryAfter as e:
+                log.warning(f"Flood limit exceeded, retrying in {e.retry_after} s")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if attempt < self.max_retries:
+                    self.retried += 1
+                    self._put((priority, seq, enqueued, chat_id, request, future, attempt + 1))
+                else:
+                    self.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                self._latencies.append(time.monotonic() - enqueued)
+                if not future.cancelled():
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        """
+        Queue depth and latency (from enqueueing to sending) of the last 1000 requests
+        """
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        return {
+            "depth": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99)
+        }
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        log.info(f"Send queue started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,64 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from utils import with_db
+import json
+
+_key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+@with_db
+async def _set_state(conn, key: str, state):
+    await conn.execute("""
+    INSERT INTO fsm_state (key, state) VALUES ($1, $2)
+    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state;
+    """, key, state)
+
+@with_db
+async def _get_state(conn, key: str):
+    return await conn.fetchval("SELECT state FROM fsm_state WHERE key = $1;", key)
+
+@with_db
+async def _set_data(conn, key: str, data: str):
+    await conn.execute("""
+    INSERT INTO fsm_state (key, data) VALUES ($1, $2::jsonb)
+    ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data;
+    """, key, data)
+
+@with_db
+async def _update_data(conn, key: str, data: str):
+    return await conn.fetchval("""
+    INSERT INTO fsm_state (key, data) VALUES ($1, $2::jsonb)
+    ON CONFLICT (key) DO UPDATE SET data = fsm_state.data || EXCLUDED.data
+    RETURNING data::text;
+    """, key, data)
+
+@with_db
+async def _get_data(conn, key: str):
+    return await conn.fetchval("SELECT data::text FROM fsm_state WHERE key = $1;", key)
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM storage in the bot's PostgreSQL database ('fsm_state' table),
+    shared by all replicas of the bot
+    """
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        if isinstance(state, State):
+            state = state.state
+        await _set_state(_key_builder.build(key), state)
+
+    async def get_state(self, key: StorageKey):
+        return await _get_state(_key_builder.build(key))
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        await _set_data(_key_builder.build(key), json.dumps(data))
+
+    async def update_data(self, key: StorageKey, data: dict) -> dict:
+        # merged in one statement, so concurrent updates don't overwrite each other
+        result = await _update_data(_key_builder.build(key), json.dumps(data))
+        return json.loads(result) if result else {}
+
+    async def get_data(self, key: StorageKey) -> dict:
+        result = await _get_data(_key_builder.build(key))
+        return json.loads(result) if result else {}
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,44 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import logging
+
+log = logging.getLogger(__name__)
+
+_finder = None
+
+def _get_finder():
+    """
+    Timezone boundary dataset with a spatial index, bundled with 'timezonefinder'.
+    Loaded on first use; the data file is memory-mapped rather than read into memory.
+    """
+    global _finder
+    if _finder is None:
+        from timezonefinder import TimezoneFinder
+        _finder = TimezoneFinder(in_memory=False)
+        log.info("Timezone dataset loaded")
+    return _finder
+
+def resolve_timezone(lat: float, lon: float):
+    """
+    Returns IANA timezone name at given coordinates without any network requests,
+    or None if it can't be resolved offline
+    """
+    try:
+        return _get_finder().timezone_at(lng=lon, lat=lat)
+    except Exception as e:
+        log.error(str(e))
+        return None
+
+def offset_minutes(tz, offset: int, when: datetime = None) -> int:
+    """
+    Returns UTC offset in minutes at the moment 'when' (now by default),
+    taking DST and non-hour offsets into account.
+    Falls back to whole-hour 'offset' if timezone name is unknown.
+    """
+    if tz:
+        try:
+            when = when or datetime.now(timezone.utc)
+            return int(when.astimezone(ZoneInfo(tz)).utcoffset().total_seconds() // 60)
+        except Exception as e:
+            log.error(str(e))
+    return offset * 60
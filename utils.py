@@ -1,194 +1,584 @@
 import asyncio
 import aiohttp
-from datetime import datetime, timezone
-import matplotlib.pyplot as plt
-import psycopg2
+import yarl
+from json import loads as json_loads
+from datetime import datetime, timedelta, timezone
+import asyncpg
 from functools import wraps
 import os
-import shutil
 from dotenv import find_dotenv, load_dotenv
 import logging
+import time
 import traceback
+from cache import TTLCache, SingleFlight
+from forecast import Forecast
+from breaker import CircuitBreaker
+from charts import render_chart_async, ChartStore
+from timezones import resolve_timezone, offset_minutes
+from metrics import STAGE_SECONDS, UPSTREAM_ERRORS, STALE_RESPONSES, Callback
+from dispatcher import utc_minute
 
 load_dotenv( find_dotenv() )
 log = logging.getLogger(__name__)
+
+# Upstream APIs; can be pointed to local stand-ins (e.g. for benchmarks)
+OPEN_METEO_URL = os.getenv('OPEN_METEO_URL', 'https://api.open-meteo.com')
+GEOAPIFY_URL = os.getenv('GEOAPIFY_URL', 'https://api.geoapify.com')
+OPENWEATHERMAP_URL = os.getenv('OPENWEATHERMAP_URL', 'http://api.openweathermap.org')
+
+# Shared HTTP client used for all upstream API requests
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', 100))
+HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', 20))
+_http_session = None
+
+async def open_http_session():
+    """
+    Creates a long-lived session with keep-alive connection pooling.
+    The number of simultaneous connections, in total and to each host, is capped.
+    """
+    global _http_session
+    connector = aiohttp.TCPConnector(limit=HTTP_LIMIT, limit_per_host=HTTP_LIMIT_PER_HOST,
+                                     ttl_dns_cache=300, keepalive_timeout=60)
+    _http_session = aiohttp.ClientSession(connector=connector,
+                                          timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    log.info("HTTP session opened")
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+        log.info("HTTP session closed")
+
+async def fetch_json(url: str):
+    """
+    Makes GET request via the shared session and returns parsed json.
+    Network errors, timeouts, 429 and 5xx responses are retried
+    (at most HTTP_RETRIES times) with exponential back-off.
+    """
+    if _http_session is None:
+        raise RuntimeError("HTTP session is not opened")
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            with STAGE_SECONDS.time(stage="fetch"):
+                async with _http_session.get(url) as response:
+                    response.raise_for_status()
+                    body = await response.read()
+            with STAGE_SECONDS.time(stage="parse"):
+                return json_loads(body)
+        except aiohttp.ClientResponseError as e:
+            UPSTREAM_ERRORS.inc(api=e.request_info.url.host)
+            if (e.status < 500 and e.status != 429) or attempt == HTTP_RETRIES:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            UPSTREAM_ERRORS.inc(api=yarl.URL(url).host)
+            if attempt == HTTP_RETRIES:
+                raise
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+# Forecasts are shared by all users within one cell of the lat/lon grid
+# (Open-Meteo's model resolution is ~1-11 km anyway) and are kept until
+# the next model update, i.e. the next multiple of FORECAST_TTL seconds.
+FORECAST_GRID = float(os.getenv('FORECAST_GRID', 0.1))
+FORECAST_TTL = int(os.getenv('FORECAST_TTL', 900))
+FORECAST_CACHE_SIZE = int(os.getenv('FORECAST_CACHE_SIZE', 10000))
+# Forecast horizon, 1 to 16 days
+FORECAST_DAYS = min(max(int(os.getenv('FORECAST_DAYS', 1)), 1), 16)
+forecast_cache = TTLCache(maxsize=FORECAST_CACHE_SIZE, ttl=FORECAST_TTL)
+
+def snap_to_grid(lat: float, lon: float) -> tuple:
+    # Center of the grid cell containing given coordinates
+    return (round(round(lat / FORECAST_GRID) * FORECAST_GRID, 4),
+            round(round(lon / FORECAST_GRID) * FORECAST_GRID, 4))
+
+def next_forecast_update() -> float:
+    # Unix time when the cached forecasts expire
+    return (time.time() // FORECAST_TTL + 1) * FORECAST_TTL
+
+def forecast_url(lats: list, lons: list) -> str:
+    # Open-Meteo accepts comma-separated lists of coordinates
+    lat = ",".join(str(x) for x in lats)
+    lon = ",".join(str(x) for x in lons)
+    return f'{OPEN_METEO_URL}/v1/forecast?latitude={lat}&longitude={lon}&daily=sunrise,sunset&hourly=temperature_2m,precipitation_probability,wind_speed_10m,apparent_temperature&current=temperature_2m,relative_humidity_2m,is_day,rain,wind_speed_10m,cloud_cover,apparent_temperature&forecast_days={FORECAST_DAYS}'
+
+def is_upstream_failure(e: Exception) -> bool:
+    # Errors showing that the upstream is unavailable, as opposed to bad requests
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+# Concurrent requests for the same cell share one API call. While Open-Meteo keeps failing,
+# the circuit breaker fails requests at once and the last good forecast of the cell
+# (if it's not older than FORECAST_STALE_TTL seconds) is served instead.
+FORECAST_STALE_TTL = int(os.getenv('FORECAST_STALE_TTL', 6 * 3600))
+stale_forecasts = TTLCache(maxsize=FORECAST_CACHE_SIZE, ttl=FORECAST_STALE_TTL)
+forecast_flight = SingleFlight()
+open_meteo_breaker = CircuitBreaker("open-meteo",
+                                    threshold=int(os.getenv('BREAKER_THRESHOLD', 5)),
+                                    reset_timeout=float(os.getenv('BREAKER_RESET_TIMEOUT', 30)))
+
+async def fetch_forecasts(cells: list) -> dict:
+    """
+    Requests forecasts for given grid cells in one API call through the circuit breaker,
+    parses them and stores them in the caches; returns them by cell
+    """
+    url = forecast_url([c[0] for c in cells], [c[1] for c in cells])
+    json = await open_meteo_breaker.call(lambda: fetch_json(url), is_upstream_failure)
+    # response is a list only when more than one location was requested
+    if isinstance(json, dict):
+        json = [json]
+    with STAGE_SECONDS.time(stage="convert"):
+        forecasts = [Forecast(cell_json) for cell_json in json]
+    expires_at = next_forecast_update()
+    for cell, forecast in zip(cells, forecasts):
+        forecast_cache.set(cell, forecast, expires_at=expires_at)
+        stale_forecasts.set(cell, forecast)
+    return dict(zip(cells, forecasts))
+
+async def get_cell_forecast(lat: float, lon: float) -> Forecast:
+    """
+    Returns the forecast for the grid cell containing given coordinates,
+    requesting the API only if it's not cached yet
+    """
+    cell = snap_to_grid(lat, lon)
+    forecast = forecast_cache.get(cell)
+    if forecast is None:
+        try:
+            forecast = await forecast_flight.do(cell, lambda: fetch_cell(cell))
+        except Exception as e:
+            forecast = stale_forecasts.get(cell)
+            if forecast is None:
+                raise
+            STALE_RESPONSES.inc(api="open-meteo")
+            log.warning(f"Serving stale forecast for {cell}: {type(e).__name__}")
+    return forecast
+
+async def fetch_cell(cell: tuple):
+    return (await fetch_forecasts([cell]))[cell]
+
+FORECAST_BATCH_SIZE = int(os.getenv('FORECAST_BATCH_SIZE', 100))
+
+async def prefetch_forecasts(coords: list):
+    """
+    Expects list of (lat, lon) pairs.
+    Fills the forecast cache for all of them, deduplicating by grid cell
+    and requesting missing cells in chunks of FORECAST_BATCH_SIZE locations per API call.
+    Cells already being requested are not requested again; concurrent requests
+    for cells of a chunk wait for the chunk.
+    Failed chunks are logged and left to be requested on demand.
+    """
+    cells = list({snap_to_grid(lat, lon) for lat, lon in coords})
+    cells = [cell for cell in cells if cell not in forecast_cache and cell not in forecast_flight]
+    chunks = [cells[i:i + FORECAST_BATCH_SIZE] for i in range(0, len(cells), FORECAST_BATCH_SIZE)]
+
+    async def fetch_chunk(request, chunk):
+        try:
+            await request
+        except Exception as e:
+            log.error(f"Prefetch of {len(chunk)} locations failed: {type(e).__name__}")
+
+    def cell_json(request, cell):
+        async def result():
+            return (await request)[cell]
+        return result
+
+    requests = []
+    for chunk in chunks:
+        request = asyncio.ensure_future(fetch_forecasts(chunk))
+        # registered right away, so that requests for these cells made meanwhile wait for the chunk
+        for cell in chunk:
+            forecast_flight.start(cell, cell_json(request, cell))
+        requests.append(fetch_chunk(request, chunk))
+    await asyncio.gather(*requests)
+    log.info(f"Prefetched {len(cells)} locations in {len(chunks)} requests")
+
+CHART_CACHE_BYTES = int(os.getenv('CHART_CACHE_MB', 256)) * 2**20
+CHART_SPILL_DIR = os.getenv('CHART_SPILL_DIR')
+chart_store = ChartStore(max_bytes=CHART_CACHE_BYTES, spill_dir=CHART_SPILL_DIR)
+
+def to_local_time(timestamp: int, tz, offset: int) -> str:
+    # Converts unix time to user's local 'H:MM'
+    when = datetime.fromtimestamp(timestamp, timezone.utc)
+    local = when + timedelta(minutes=offset_minutes(tz, offset, when))
+    return f"{local.hour}:{local.minute:02d}"
+
+# Users of the same cell asking at once wait for one rendering of the chart
+chart_flight = SingleFlight()
+
+async def render_forecast_chart(key: str, hourly: dict) -> bytes:
+    with STAGE_SECONDS.time(stage="render"):
+        chart = await render_chart_async(hourly)
+    with STAGE_SECONDS.time(stage="save"):
+        chart_store.set(key, chart, expires_at=next_forecast_update())
+    return chart
+
 async def make_forecast(user_data):
     """
-    Expects tuple with user data from the database.
-    Requests data from (free) API, creates a graph (if not already exists)
-    and stores it in 'graphs' folder with name given by user's chat_id,
-    returns weather data as json.
+    Expects user's data from the database.
+    Requests data from (free) API or the forecast cache, takes the chart from the chart store
+    (rendering it if it's not there yet), returns weather data as json along with the chart.
+    Charts are shared by all users within one grid cell and are redrawn once the forecast updates.
     """
-    chat_id = user_data[0]
     answer = {}
     try:
-        lat, lon, offset = user_data[1:-1]
-        url = f'https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=sunrise,sunset&hourly=temperature_2m,precipitation_probability,wind_speed_10m,apparent_temperature&current=temperature_2m,relative_humidity_2m,is_day,rain,wind_speed_10m,cloud_cover,apparent_temperature&forecast_days=1'
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                json = await response.json()
+        lat, lon, offset, tz = user_data.lat, user_data.lon, user_data.tz_offset, user_data.tz
+        forecast = await get_cell_forecast(lat, lon)
         answer["status"] = "OK"
-        current_data = {
-            "temp": json["current"]["temperature_2m"],
-            "apparent_temp": json["current"]["apparent_temperature"],
-            "hum": json["current"]["relative_humidity_2m"],
-            "is_day": json["current"]["is_day"],
-            "wind_speed": json["current"]["wind_speed_10m"],
-            "clouds": json["current"]["cloud_cover"]
-        }
-        hourly_data = {
-            "temp": json["hourly"]["temperature_2m"],
-            "apparent_temp": json["hourly"]["apparent_temperature"],
-            "precipitation_prob": json["hourly"]["precipitation_probability"],
-            "wind": json["hourly"]["wind_speed_10m"]
-        }
-        sunrise_raw = json["daily"]["sunrise"][0].split("T")[1]
-        h,m = sunrise_raw.split(":")
-        sunrise = str( ( int(h) + offset ) % 24 ) + ":" + m
-        sunset_raw = json["daily"]["sunset"][0].split("T")[1]
-        h,m = sunset_raw.split(":")
-        sunset = str( ( int(h) + offset ) % 24 ) + ":" + m
+        # days are summarized from user's local midnight
+        daily = forecast.daily(offset_minutes(tz, offset))
+        for day in daily:
+            for event in ("sunrise", "sunset"):
+                day[event] = "-" if day[event] is None else to_local_time(day[event], tz, offset)
         answer["data"] = {
-            "current": current_data,
-            "hourly": hourly_data,
-            "sunrise": sunrise,
-            "sunset": sunset
+            "current": forecast.current,
+            "hourly": forecast.hourly(),
+            "daily": daily,
+            "sunrise": daily[0]["sunrise"],
+            "sunset": daily[0]["sunset"]
         }
-        if not os.path.isfile(os.path.join("graphs", f"{chat_id}.png")):
-            hours = [i for i in range(0, 24)]
-            plt.rcParams.update({'font.size': 14})
-            plt.style.use('dark_background')
-            fig, ax1 = plt.subplots(figsize=(16,9))
-            graph1, = ax1.plot(hours, answer["data"]["hourly"]["temp"], 's-',
-                     markersize=5, color='cyan', label = 'temperature', zorder=2)
-            graph2, = ax1.plot(hours, answer["data"]["hourly"]["apparent_temp"], 'D-',
-                     markersize=5, color='blueviolet', label = 'apparent temperature')
-            ax2 = ax1.twinx()
-            graph3, = ax2.plot(hours, answer["data"]["hourly"]["wind"], 'o-',
-                     markersize=5, color='lime', label = 'wind')
-            ax1.grid()
-            ax1.set_xticks(hours)
-            ax1.set_xlabel('Hours')
-            ax1.set_xlim(-0.5,23.5)
-            ax1.set_ylabel("°C")
-            ax2.set_ylabel("km/h")
-            ax2.spines['left'].set_position(('outward', 50))
-            ax2.yaxis.set_label_position('left')
-            ax2.yaxis.set_ticks_position('left')
-            if max(answer["data"]["hourly"]["precipitation_prob"]) >= 5:
-                ax3 = ax1.twinx()
-                graph4 = ax3.bar(hours, answer["data"]["hourly"]["precipitation_prob"],
-                                  color='coral', alpha=0.5,label="precipitation prob.")
-                ax3.set_ylabel("%")
-                ax3.spines['left'].set_position(('outward', 100))
-                ax3.yaxis.set_label_position('left')
-                ax3.yaxis.set_ticks_position('left')
-                graphs = [graph1, graph2, graph3, graph4]
-            else:
-                graphs = [graph1, graph2, graph3]
-            labels = [graph.get_label() for graph in graphs]
-            ax1.legend(graphs, labels, loc="lower left")
-            os.makedirs("graphs", exist_ok=True)
-            plt.savefig(os.path.join("graphs", f"{chat_id}.png"), bbox_inches="tight")
+        # chart is identified by the grid cell and the time of forecast's update
+        cell = snap_to_grid(lat, lon)
+        key = f'{cell[0]},{cell[1]}@{forecast.updated}'
+        chart = chart_store.get(key)
+        if chart is None:
+            chart = await chart_flight.do(key, lambda: render_forecast_chart(key, answer["data"]["hourly"]))
+        answer["chart"] = {"key": key, "data": chart}
     except Exception:
         answer["status"] = "not OK"
         answer["info"] =  traceback.format_exc()
     return answer
 
-def clear_graphs():
-    # Clears 'graphs' folder
-    shutil.rmtree(os.path.abspath("graphs"), ignore_errors=True)
-    os.makedirs("graphs", exist_ok=True)
-    log.info("'graphs' folder cleared")
-
 async def get_offset_by_loc(lat, lon):
     """
-    Makes request to the API and returns user's timezone w.r.t. GMT
+    Returns user's timezone as (offset w.r.t. GMT in whole hours, IANA name).
+    Timezone is resolved offline; the API is requested only as a fallback.
     """
     try:
-        KEY_TIMEZONE = os.getenv('KEY_TIMEZONE')
-        url = f"https://api.geoapify.com/v1/geocode/reverse?lat={lat}&lon={lon}&apiKey={KEY_TIMEZONE}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                json = await response.json()
-                offset = int(json["features"][0]["properties"]["timezone"]["offset_STD"].split(":")[0])
-                return {"status": "OK", "data": offset}
+        tz = resolve_timezone(lat, lon)
+        if tz is None:
+            KEY_TIMEZONE = os.getenv('KEY_TIMEZONE')
+            url = f"{GEOAPIFY_URL}/v1/geocode/reverse?lat={lat}&lon={lon}&apiKey={KEY_TIMEZONE}"
+            json = await fetch_json(url)
+            timezone_info = json["features"][0]["properties"]["timezone"]
+            tz = timezone_info.get("name")
+            if not tz:
+                offset = int(timezone_info["offset_STD"].split(":")[0])
+                return {"status": "OK", "data": (offset, None)}
+        offset = int(offset_minutes(tz, 0) / 60)
+        return {"status": "OK", "data": (offset, tz)}
     except Exception:
         return {"status": "not OK", "info": traceback.format_exc()}
 
+# Resolved cities are cached in the database and in memory in front of it.
+# Unknown names are cached too, but for a shorter time.
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', 10000))
+GEOCODE_TTL = int(os.getenv('GEOCODE_TTL', 30 * 86400))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', 86400))
+geocode_cache = TTLCache(maxsize=GEOCODE_CACHE_SIZE, ttl=GEOCODE_TTL)
+CITY_NOT_FOUND = "not_found"
+
+def normalize_city(city: str) -> str:
+    return " ".join(city.lower().split())
+
 async def get_loc_by_city(city: str):
     """
-    Makes request to the API and returns user's coordinates
+    Returns user's coordinates, looking them up in the geocoding cache
+    before making requests to the API
     """
     try:
+        name = normalize_city(city)
+        cached = geocode_cache.get(name)
+        if cached is None:
+            cached = await get_cached_city(name)
+            if cached is not None:
+                ttl = GEOCODE_NEGATIVE_TTL if cached == CITY_NOT_FOUND else GEOCODE_TTL
+                geocode_cache.set(name, cached, expires_at=time.time() + ttl)
+        if cached == CITY_NOT_FOUND:
+            return {"status": "not OK", "info": f"City not found: {city}"}
+        if cached is not None:
+            return {"status": "OK", "data": list(cached)}
         KEY_COORDS = os.getenv('KEY_COORDS')
-        url = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&appid={KEY_COORDS}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                json = await response.json()
-                lat, lon = float(json[0]["lat"]), float(json[0]["lon"])
-                offset_response = await get_offset_by_loc(lat,lon)
+        url = f"{OPENWEATHERMAP_URL}/geo/1.0/direct?q={name}&appid={KEY_COORDS}"
+        json = await fetch_json(url)
+        if not json:
+            geocode_cache.set(name, CITY_NOT_FOUND, expires_at=time.time() + GEOCODE_NEGATIVE_TTL)
+            await cache_city(name, None)
+            return {"status": "not OK", "info": f"City not found: {city}"}
+        lat, lon = float(json[0]["lat"]), float(json[0]["lon"])
+        offset_response = await get_offset_by_loc(lat,lon)
         if offset_response["status"] == "not OK":
             return {"status": "not OK", "info": str(offset_response["info"])}
-        offset = offset_response["data"]
-        return {"status": "OK", "data": [lat, lon, offset]}
+        offset, tz = offset_response["data"]
+        geocode_cache.set(name, (lat, lon, offset, tz))
+        await cache_city(name, (lat, lon, offset, tz))
+        return {"status": "OK", "data": [lat, lon, offset, tz]}
     except Exception:
         return {"status": "not OK", "info": traceback.format_exc()}
 
-def get_my_offset() ->int:
-    # System's timezone w.r.t. GMT
-    return int(datetime.now().astimezone().utcoffset().total_seconds() / 3600)
-
 DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST') #change to localhost in .env when running outside docker container
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+_db_pool = None
+
+async def open_db_pool():
+    """
+    Creates a bounded pool of database connections, which is shared by all queries
+    """
+    global _db_pool
+    _db_pool = await asyncpg.create_pool(database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                                         host=DB_HOST, port=5432,
+                                         min_size=DB_POOL_MIN, max_size=DB_POOL_MAX)
+    log.info("Database pool opened")
+
+async def close_db_pool():
+    global _db_pool
+    if _db_pool is not None:
+        await _db_pool.close()
+        _db_pool = None
+        log.info("Database pool closed")
+
+def acquire():
+    # Connection from the pool, for work spanning several transactions (e.g. migrations)
+    return _db_pool.acquire()
+
 def with_db(func):
+    """
+    Acquires a connection from the pool and runs the decorated coroutine
+    inside a transaction. Errors are logged and None is returned.
+    """
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=5432)
-        cur = conn.cursor()
+    async def wrapper(*args, **kwargs):
         try:
-            result = func(cur,*args, **kwargs)
-            conn.commit()
-            return result
+            async with _db_pool.acquire() as conn:
+                async with conn.transaction():
+                    return await func(conn, *args, **kwargs)
         except Exception as e:
-            conn.rollback()
             log.error(str(e))
-        finally:
-            cur.close()
-            conn.close()
     return wrapper
 
 @with_db
-def db_exists(cur, dbname: str)->bool:
-    cur.execute("""
-    SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name = %s);
-    """, (dbname,))
-    exists = cur.fetchall()[0][0]
-    return exists
+async def get_cached_city(conn, name: str):
+    """
+    Returns (lat, lon, tz_offset, tz) of the city from the geocoding cache table,
+    CITY_NOT_FOUND for cached unknown names and None if it's not cached or expired
+    """
+    query = """
+    SELECT lat, lon, tz_offset, tz FROM geocode_cache
+    WHERE city = $1
+    AND updated_at > now() - make_interval(secs => CASE WHEN lat IS NULL THEN $3::float8 ELSE $2::float8 END);
+    """
+    row = await conn.fetchrow(query, name, float(GEOCODE_TTL), float(GEOCODE_NEGATIVE_TTL))
+    if row is None:
+        return None
+    if row[0] is None:
+        return CITY_NOT_FOUND
+    return tuple(row)
+
+@with_db
+async def cache_city(conn, name: str, coords):
+    # coords is None for unknown cities
+    lat, lon, offset, tz = coords if coords is not None else (None, None, None, None)
+    query = """
+    INSERT INTO geocode_cache (city, lat, lon, tz_offset, tz, updated_at)
+    VALUES ($1, $2, $3, $4, $5, now())
+    ON CONFLICT (city) DO UPDATE
+    SET lat = EXCLUDED.lat, lon = EXCLUDED.lon, tz_offset = EXCLUDED.tz_offset,
+        tz = EXCLUDED.tz, updated_at = now();
+    """
+    await conn.execute(query, name, lat, lon, offset, tz)
+
+class User:
+    """
+    User's row from the database.
+    Notification time is stored as minutes of the day, both local and UTC.
+    """
+    __slots__ = ("chat_id", "lat", "lon", "tz_offset", "tz", "notify_local", "notify_minute")
+
+    def __init__(self, chat_id, lat, lon, tz_offset, tz, notify_local, notify_minute):
+        self.chat_id = chat_id
+        self.lat = lat
+        self.lon = lon
+        self.tz_offset = tz_offset
+        self.tz = tz
+        self.notify_local = notify_local
+        self.notify_minute = notify_minute
+
+USER_COLUMNS = "chat_id, lat, lon, tz_offset, tz, notify_local, notify_minute"
+# Read-through cache of users' rows, invalidated on every write.
+# Writes made through one replica can't invalidate the caches of the others,
+# so with several replicas (sharded notifications or shared FSM state) it's disabled.
+SEVERAL_REPLICAS = (int(os.getenv('NOTIFY_SHARDS', 0)) > 0
+                    or os.getenv('FSM_STORAGE', 'memory') == 'postgres')
+USER_CACHE_SIZE = 0 if SEVERAL_REPLICAS else int(os.getenv('USER_CACHE_SIZE', 200000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 3600))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# User's current UTC offset in minutes, following DST for known timezones
+OFFSET_MINUTES_SQL = """
+CASE WHEN tz IS NOT NULL
+     THEN (EXTRACT(EPOCH FROM (now() AT TIME ZONE tz) - (now() AT TIME ZONE 'UTC')) / 60)::int
+     ELSE tz_offset * 60 END
+"""
+# User's shard, given the number of shards 'n'; group chats have negative ids
+# and % takes the sign of the dividend, so the remainder is shifted to 0..n-1
+SHARD_SQL = "((chat_id % {n}) + {n}) % {n}"
 
 @with_db
-def add_user(cur, chat_id, coords, notify_time):
-    lat, lon, offset = coords
+async def add_user(conn, chat_id: int, coords, notify_time):
+    """
+    'notify_time' is user's local time of daily forecast as 'HH:MM', or None
+    """
+    lat, lon, offset, tz = coords
+    notify_local = notify_minute = None
+    if notify_time:
+        h,m = notify_time.split(":")
+        notify_local = int(h) * 60 + int(m)
+        notify_minute = utc_minute(int(h), int(m), offset_minutes(tz, offset))
     query = """
-    INSERT INTO weatherbot (chat_id, lat, lon, tz_offset, notify)
-    VALUES (%s, %s, %s, %s, %s);
+    INSERT INTO weatherbot (chat_id, lat, lon, tz_offset, tz, notify_local, notify_minute)
+    VALUES ($1, $2, $3, $4, $5, $6, $7);
     """
-    cur.execute(query, (chat_id, lat, lon, offset, notify_time))
+    await conn.execute(query, chat_id, lat, lon, offset, tz, notify_local, notify_minute)
+    user_cache.pop(chat_id)
 
 @with_db
-def delete_user(cur, chat_id: str):
+async def delete_user(conn, chat_id: int):
     query="""
-    DELETE FROM weatherbot WHERE chat_id = %s;
+    DELETE FROM weatherbot WHERE chat_id = $1;
     """
-    cur.execute(query, (chat_id,))
+    await conn.execute(query, chat_id)
+    user_cache.pop(chat_id)
     log.info("User deleted")
 
 @with_db
-def get_user(cur, chat_id: str):
-    query="""
-    SELECT * FROM weatherbot WHERE chat_id = %s
+async def _select_users(conn, chat_ids: list) -> list:
+    query=f"""
+    SELECT {USER_COLUMNS} FROM weatherbot WHERE chat_id = ANY($1)
+    """
+    rows = await conn.fetch(query, chat_ids)
+    return [User(*row) for row in rows]
+
+async def get_users(chat_ids: list) -> list:
     """
-    cur.execute(query, (chat_id,))
-    return cur.fetchone()
\ No newline at end of file
+    Returns users found in the database, taking cached ones from the cache
+    and loading the rest in one query
+    """
+    users = []
+    missing = []
+    for chat_id in chat_ids:
+        user = user_cache.get(chat_id)
+        if user is None:
+            missing.append(chat_id)
+        else:
+            users.append(user)
+    if missing:
+        loaded = await _select_users(missing) or []
+        for user in loaded:
+            user_cache.set(user.chat_id, user)
+        users.extend(loaded)
+    return users
+
+async def get_user(chat_id: int):
+    user = user_cache.get(chat_id)
+    if user is None:
+        users = await _select_users([chat_id])
+        if users:
+            user = users[0]
+            user_cache.set(chat_id, user)
+    return user
+
+LOAD_BATCH_SIZE = int(os.getenv('LOAD_BATCH_SIZE', 5000))
+
+@with_db
+async def load_users(conn, add, warm_cache: bool = True, skip: set = ()) -> int:
+    """
+    Streams all users subscribed to daily forecasts from one query through a cursor,
+    LOAD_BATCH_SIZE rows at a time, passing each of them to 'add'.
+    Optionally warms up the users' cache with them. Users whose chat_ids are in 'skip'
+    (which may grow while loading) are left out. Returns the number of users.
+    """
+    query=f"""
+    SELECT {USER_COLUMNS} FROM weatherbot WHERE notify_minute IS NOT NULL
+    """
+    count = 0
+    async for row in conn.cursor(query, prefetch=LOAD_BATCH_SIZE):
+        user = User(*row)
+        if user.chat_id in skip:
+            continue
+        add(user)
+        if warm_cache and count < USER_CACHE_SIZE:
+            user_cache.set(user.chat_id, user)
+        count += 1
+    return count
+
+@with_db
+async def claim_due_users(conn, minute: int, planned: float, shards: list, shard_count: int) -> list:
+    """
+    Returns chat_ids of users from given shards due at 'minute', marking them as notified
+    for the slot scheduled at 'planned' (unix time). Users claimed for this slot before
+    (e.g. by another replica before failover) or locked by a concurrent claim are skipped.
+    """
+    query=f"""
+    WITH due AS (
+        SELECT chat_id FROM weatherbot
+        WHERE notify_minute = $1 AND {SHARD_SQL.format(n='$4')} = ANY($3::int[])
+        AND (notified_at IS NULL OR notified_at < $2)
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE weatherbot w SET notified_at = $2
+    FROM due WHERE w.chat_id = due.chat_id
+    RETURNING w.chat_id;
+    """
+    planned = datetime.fromtimestamp(planned, timezone.utc)
+    rows = await conn.fetch(query, minute, planned, shards, shard_count)
+    return [row[0] for row in rows]
+
+@with_db
+async def peek_due_users(conn, minute: int, shards: list, shard_count: int) -> list:
+    """
+    Returns chat_ids of users from given shards due at 'minute', without claiming them
+    """
+    query=f"""
+    SELECT chat_id FROM weatherbot
+    WHERE notify_minute = $1 AND {SHARD_SQL.format(n='$3')} = ANY($2::int[]);
+    """
+    rows = await conn.fetch(query, minute, shards, shard_count)
+    return [row[0] for row in rows]
+
+@with_db
+async def refresh_notify_minutes(conn) -> list:
+    """
+    Recomputes UTC notification minutes of users with known timezone,
+    so that they follow DST changes. Returns (chat_id, new minute) of the changed users.
+    """
+    query=f"""
+    UPDATE weatherbot
+    SET notify_minute = ((notify_local - {OFFSET_MINUTES_SQL}) % 1440 + 1440) % 1440
+    WHERE notify_local IS NOT NULL AND tz IS NOT NULL
+    AND notify_minute IS DISTINCT FROM ((notify_local - {OFFSET_MINUTES_SQL}) % 1440 + 1440) % 1440
+    RETURNING chat_id, notify_minute;
+    """
+    changed = [(row[0], row[1]) for row in await conn.fetch(query)]
+    for chat_id, minute in changed:
+        user_cache.pop(chat_id)
+    log.info(f"Notification times refreshed: {len(changed)} changed")
+    return changed
+
+Callback("weatherbot_cache_hits_total", "Cache hits",
+         lambda: {"forecast": forecast_cache.hits, "chart": chart_store.hits,
+                  "user": user_cache.hits, "geocode": geocode_cache.hits},
+         kind="counter", label="cache")
+Callback("weatherbot_cache_misses_total", "Cache misses",
+         lambda: {"forecast": forecast_cache.misses, "chart": chart_store.misses,
+                  "user": user_cache.misses, "geocode": geocode_cache.misses},
+         kind="counter", label="cache")
+Callback("weatherbot_coalesced_requests_total", "Requests served by a call already in flight",
+         lambda: {"forecast": forecast_flight.shared, "chart": chart_flight.shared},
+         kind="counter", label="cache")
+Callback("weatherbot_circuit_open", "Whether calls to the upstream API are being cut off",
+         lambda: {"open-meteo": int(open_meteo_breaker.state != "closed")}, label="api")